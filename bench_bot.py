@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import os
+import time
+
+from aiohttp import web
+
+import bench_common
+import fake_telegram_api
+import metrics
+from bench_common import report
+
+ADMIN_ID = 1881684121
+FIRST_USER_ID = 10_000
+
+# Запуск fake Bot API в этом же процессе на свободном порту
+async def start_fake_api():
+    runner = web.AppRunner(fake_telegram_api.create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+# Импорт бота из временной папки (все файлы данных создаются там) с адресом fake API
+def import_bot(api_url):
+    os.environ["BOT_TOKEN"] = bench_common.BENCH_BOT_TOKEN
+    os.environ["TELEGRAM_API_URL"] = api_url
+    os.environ["METRICS_PORT"] = "0"
+    return bench_common.import_bot(stay_in_tempdir=True)
+
+def percentile(values, quantile):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(quantile * len(values)))] if values else 0.0
+
+# Подача обновлений в диспетчер с заданной частотой (0 — все сразу); возвращает задержки обработки
+async def replay(bot_module, updates, rate):
+    from aiogram import types
+
+    latencies = []
+
+    async def process(update):
+        start = time.perf_counter()
+        await bot_module.dp.process_update(types.Update(**update))
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    start = time.perf_counter()
+    for index, update in enumerate(updates):
+        update["update_id"] = index + 1
+        if rate:
+            delay = start + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(process(update)))
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - start
+
+def api_calls():
+    return sum(fake_telegram_api.method_calls.values())
+
+def describe_run(name, updates, latencies, elapsed, calls):
+    return (
+        f"{name}: {updates} обновлений за {elapsed:.2f} с ({updates / elapsed:.0f} обн./с), "
+        f"задержка p50 {percentile(latencies, 0.5) * 1000:.0f} мс, p99 {percentile(latencies, 0.99) * 1000:.0f} мс, "
+        f"вызовов API {calls}"
+    )
+
+# Одновременные нажатия "Получить следующую группу": проверяем, что группы не выдаются дважды
+async def bench_groups(bot_module, users, rate):
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    calls_before = api_calls()
+    updates = [fake_telegram_api.make_callback_update(user_id, "get_next_group") for user_id in user_ids]
+    latencies, elapsed = await replay(bot_module, updates, rate)
+    assigned = [group_index for user_id in user_ids for group_index in bot_module.sent_groups.get(user_id, [])]
+    duplicates = len(assigned) - len(set(assigned))
+    line = describe_run("Получить следующую группу", len(updates), latencies, elapsed, api_calls() - calls_before)
+    return [line, f"  выдано групп: {len(assigned)}, повторных выдач: {duplicates}"]
+
+# Администратор меняет статусы пользователей
+async def bench_status(bot_module, changes, rate):
+    calls_before = api_calls()
+    updates = [
+        fake_telegram_api.make_callback_update(ADMIN_ID, f"set_status:{FIRST_USER_ID + i}:{'✅' if i % 2 else '❌'}")
+        for i in range(changes)
+    ]
+    latencies, elapsed = await replay(bot_module, updates, rate)
+    await bot_module.flush_dirty_data()
+    return [describe_run("Смена статуса администратором", len(updates), latencies, elapsed, api_calls() - calls_before)]
+
+# Альбомы из нескольких фото: обработчик только собирает файлы, загрузка идет после паузы альбома
+async def bench_albums(bot_module, albums, photos, rate):
+    calls_before = api_calls()
+    saves_before = sum(count for count, *_ in metrics.histogram_summary("bot_media_save_seconds").values())
+    updates = []
+    for album in range(albums):
+        for photo in range(photos):
+            update = fake_telegram_api.make_message_update(FIRST_USER_ID + album, "")
+            message = update["message"]
+            del message["text"]
+            message["media_group_id"] = f"album{album}"
+            message["photo"] = [{"file_id": f"photo{album}_{photo}", "file_unique_id": f"u{album}_{photo}", "width": 90, "height": 90}]
+            updates.append(update)
+    latencies, elapsed = await replay(bot_module, updates, rate)
+    # Ждем, пока все альбомы будут загружены и сохранены
+    start = time.perf_counter()
+    while sum(count for count, *_ in metrics.histogram_summary("bot_media_save_seconds").values()) - saves_before < albums:
+        if time.perf_counter() - start > 60:
+            break
+        await asyncio.sleep(0.05)
+    saved = time.perf_counter() - start + elapsed
+    summary = metrics.histogram_summary("bot_media_save_seconds")
+    save_p95 = max((p95 for *_, p95 in summary.values()), default=0)
+    return [
+        describe_run("Альбомы", len(updates), latencies, elapsed, api_calls() - calls_before),
+        f"  все {albums} альбомов сохранены через {saved:.2f} с, p95 сохранения ≤{save_p95:g} с",
+    ]
+
+async def bench_bot(args):
+    runner, api_url = await start_fake_api()
+    bot_module = import_bot(api_url)
+    from aiogram import Bot
+
+    Bot.set_current(bot_module.bot)
+    if args.send_rate:
+        bot_module.GLOBAL_SEND_RATE = args.send_rate
+        bot_module.global_bucket[0] = args.send_rate
+    if args.chat_rate:
+        bot_module.CHAT_SEND_RATE = args.chat_rate
+        bot_module.CHAT_SEND_BURST = max(bot_module.CHAT_SEND_BURST, args.chat_rate)
+    bot_module.MEDIA_GROUP_DEBOUNCE = args.album_debounce
+    bot_module.users_status.update({FIRST_USER_ID + i: "" for i in range(args.users)})
+    bot_module.groups_data = [[(f"https://lichess.org/team/club-{i}", i % 7)] for i in range(args.groups)]
+    bot_module.reset_group_dispenser()
+    await bot_module.on_startup(bot_module.dp)
+
+    lines = [
+        f"== Нагрузка на бота: {args.users} пользователей, частота {args.rate or 'без ограничения'} обн./с, "
+        f"лимит отправки {bot_module.GLOBAL_SEND_RATE} сообщ./с, в чат {bot_module.CHAT_SEND_RATE} сообщ./с =="
+    ]
+    lines += await bench_groups(bot_module, args.users, args.rate)
+    lines += await bench_status(bot_module, args.status_changes, args.rate)
+    lines += await bench_albums(bot_module, args.albums, args.photos, args.rate)
+    report(lines)
+
+    await bot_module.on_shutdown(bot_module.dp)
+    await (await bot_module.bot.get_session()).close()
+    await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с локальной заменой Bot API")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="обновлений в секунду (0 — все сразу)")
+    parser.add_argument("--status-changes", type=int, default=20)
+    parser.add_argument("--albums", type=int, default=50)
+    parser.add_argument("--photos", type=int, default=3)
+    parser.add_argument("--album-debounce", type=float, default=0.5)
+    parser.add_argument("--send-rate", type=float, default=0, help="заменить GLOBAL_SEND_RATE (0 — как в боте)")
+    parser.add_argument("--chat-rate", type=float, default=0, help="заменить CHAT_SEND_RATE (0 — как в боте)")
+    args = parser.parse_args()
+    asyncio.run(bench_bot(args))
@@ -0,0 +1,29 @@
+import importlib
+import os
+import sys
+import tempfile
+
+# Общие части замеров. Результаты всех замеров дописываются в один файл; путь фиксируется
+# при импорте, потому что замеры потом переходят во временные папки
+BENCH_OUTPUT_FILE = os.path.abspath("bench_output.txt")
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_BOT_TOKEN = "123456:bench-token-not-used-for-requests"
+
+def report(lines):
+    for line in lines:
+        print(line)
+    with open(BENCH_OUTPUT_FILE, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+# Бот при импорте создает папку для медиа и проверяет формат токена, поэтому импортируем
+# его из временной папки с фиктивным токеном. С stay_in_tempdir=True замер остается
+# в этой папке, чтобы файлы данных бота создавались там же
+def import_bot(stay_in_tempdir=False):
+    os.environ.setdefault("BOT_TOKEN", BENCH_BOT_TOKEN)
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    sys.path.insert(0, BENCH_DIR)
+    bot_module = importlib.import_module("bot_chess_copy")
+    if not stay_in_tempdir:
+        os.chdir(cwd)
+    return bot_module
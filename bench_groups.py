@@ -0,0 +1,72 @@
+import argparse
+import random
+import statistics
+import time
+
+import bench_common
+from bench_common import report
+
+bot_chess_copy = bench_common.import_bot()
+
+# Синтетические клубы: большинство с 0–2 активными админами, редкие — с десятками
+def make_clubs(count, seed):
+    rng = random.Random(seed)
+    return [(f"https://lichess.org/team/club-{i}", min(40, int(rng.expovariate(0.4)))) for i in range(count)]
+
+# Прежний алгоритм: create_group снимал одну группу с начала списка и фильтровал
+# остаток через `i not in removed_indices` (список), пока клубы не закончатся
+def create_groups_legacy(data, group_size, target_sum):
+    data_sorted = sorted(data, key=lambda x: x[1], reverse=True)
+    groups = []
+    while data_sorted:
+        current_group = []
+        current_sum = 0
+        removed_indices = []
+        for i, (club_url, admins) in enumerate(data_sorted):
+            if len(current_group) < group_size and current_sum + admins <= target_sum:
+                current_group.append((club_url, admins))
+                current_sum += admins
+                removed_indices.append(i)
+            if len(current_group) == group_size or current_sum >= target_sum:
+                break
+        if not current_group:
+            # Клуб больше target_sum не помещается ни в одну группу — отдельная группа
+            current_group = [data_sorted[0]]
+            removed_indices = [0]
+        data_sorted = [item for i, item in enumerate(data_sorted) if i not in removed_indices]
+        groups.append(current_group)
+    return groups
+
+def describe(groups):
+    sums = [sum(admins for _, admins in group) for group in groups]
+    return f"{len(groups)} групп, сумма админов min {min(sums)} / max {max(sums)} / σ {statistics.pstdev(sums):.2f}"
+
+def bench_groups(clubs, legacy_clubs, group_size, target_sum):
+    lines = [f"== Формирование групп (размер {group_size}, цель {target_sum}) =="]
+    data = make_clubs(clubs, seed=1)
+    start = time.perf_counter()
+    groups = bot_chess_copy.create_groups(data, group_size, target_sum)
+    elapsed = time.perf_counter() - start
+    if sorted(club for group in groups for club in group) != sorted(data):
+        raise SystemExit("create_groups потерял или продублировал клубы")
+    lines.append(f"create_groups, {clubs} клубов: {elapsed * 1000:.0f} мс, {describe(groups)}")
+    # Старый алгоритм квадратичный, поэтому замеряем его на меньшем наборе
+    data = make_clubs(legacy_clubs, seed=1)
+    start = time.perf_counter()
+    groups = bot_chess_copy.create_groups(data, group_size, target_sum)
+    elapsed = time.perf_counter() - start
+    lines.append(f"create_groups, {legacy_clubs} клубов: {elapsed * 1000:.1f} мс, {describe(groups)}")
+    start = time.perf_counter()
+    groups = create_groups_legacy(data, group_size, target_sum)
+    elapsed = time.perf_counter() - start
+    lines.append(f"прежний create_group, {legacy_clubs} клубов: {elapsed * 1000:.0f} мс, {describe(groups)}")
+    report(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры формирования групп клубов")
+    parser.add_argument("--clubs", type=int, default=100_000)
+    parser.add_argument("--legacy-clubs", type=int, default=5_000)
+    parser.add_argument("--size", type=int, default=10)
+    parser.add_argument("--target", type=int, default=20)
+    args = parser.parse_args()
+    bench_groups(args.clubs, args.legacy_clubs, args.size, args.target)
@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import metrics
+import parsing_copy
+from bench_common import report
+
+# Сохраненные страницы клуба и профиля для офлайн-замеров
+FIXTURES_DIR = os.path.abspath("bench_fixtures")
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+# Среднее время одного вызова в миллисекундах
+def measure(func, html, iterations):
+    func(html)  # прогрев
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func(html)
+    return (time.perf_counter() - start) / iterations * 1000
+
+# Сравнение быстрого разбора с BeautifulSoup на сохраненных страницах
+def bench_extract(iterations):
+    club_html = load_fixture("club.html")
+    profile_html = load_fixture("profile.html")
+    cases = [
+        ("club.html", club_html, parsing_copy.extract_admin_hrefs_bs4, parsing_copy.extract_admin_hrefs_fast),
+        ("profile.html", profile_html, parsing_copy.extract_last_seen_bs4, parsing_copy.extract_last_seen_fast),
+    ]
+    lines = [f"== Разбор HTML ({iterations} итераций) =="]
+    for name, html, bs4_func, fast_func in cases:
+        if bs4_func(html) != fast_func(html):
+            raise SystemExit(f"Результаты разбора {name} не совпадают: {bs4_func(html)} != {fast_func(html)}")
+        bs4_ms = measure(bs4_func, html, iterations)
+        fast_ms = measure(fast_func, html, iterations)
+        lines.append(
+            f"{name} ({len(html) // 1024} КБ): bs4 {bs4_ms:.2f} мс, fast {fast_ms:.3f} мс, "
+            f"ускорение x{bs4_ms / fast_ms:.0f}"
+        )
+    report(lines)
+
+# Запуск fake_lichess.py в отдельном процессе, чтобы его потоки не попадали в замер CPU парсера
+@contextlib.contextmanager
+def fake_lichess_server(args):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_lichess.py")
+    process = subprocess.Popen(
+        [sys.executable, script, "--port", "0", "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+         "--throttle-rate", str(args.throttle_rate), "--retry-after", str(args.retry_after), "--admin-pool", str(args.admin_pool)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    try:
+        yield process.stdout.readline().strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+# Время CPU потоков обхода, потраченное на разбор страниц
+parse_cpu = {"seconds": 0.0}
+parse_cpu_lock = threading.Lock()
+
+def count_parse_cpu(func):
+    def wrapper(html):
+        start = time.thread_time()
+        try:
+            return func(html)
+        finally:
+            with parse_cpu_lock:
+                parse_cpu["seconds"] += time.thread_time() - start
+    return wrapper
+
+def fetch_seconds():
+    return sum(count * mean for count, mean, _, _ in metrics.histogram_summary("crawler_fetch_seconds").values())
+
+# Холодный обход: пустые кэши, журнал и скорость, заданная для замера (0 — без ограничения)
+def reset_crawler(rate):
+    parsing_copy.admin_cache.clear()
+    parsing_copy.admin_url_locks.clear()
+    rate = rate or 1e9
+    parsing_copy.RATE_LIMIT_MAX = max(parsing_copy.RATE_LIMIT_MAX, rate)
+    parsing_copy.rate_state.update(rate=rate, tokens=1.0, updated=time.monotonic(), paused_until=0.0)
+    parse_cpu["seconds"] = 0.0
+
+# Пиковая память этапа: с tracemalloc — пик объектов Python за этап (замедляет обход в несколько раз),
+# без него — пиковый RSS процесса с начала работы (при росте размеров списка это пик последнего обхода)
+def peak_memory_mb(trace_memory):
+    if trace_memory:
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Обход n клубов локальной копии lichess и пересчет колонки AF по получившемуся файлу
+def bench_crawl_size(base_url, clubs, args):
+    workdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        with open("clubs_domens.txt", "w") as f:
+            f.write("\n".join(f"{base_url}/team/club-{i}" for i in range(clubs)) + "\n")
+        reset_crawler(args.rate)
+        fetch_before = fetch_seconds()
+        if args.trace_memory:
+            tracemalloc.start()
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            parsing_copy.collect_data(workers=args.workers)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        crawl_peak = peak_memory_mb(args.trace_memory)
+        failed = metrics.gauge_value("crawler_clubs_total", 0, result="failed")
+        network = fetch_seconds() - fetch_before
+
+        if args.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            parsing_copy.calculate_af_column()
+        af_elapsed = time.perf_counter() - start
+        af_peak = peak_memory_mb(args.trace_memory)
+        if args.trace_memory:
+            tracemalloc.stop()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return [
+        f"{clubs} клубов: {elapsed:.2f} с, {clubs / elapsed:.1f} клуб./с, не обработано {failed}; "
+        f"CPU {cpu:.2f} с, из них разбор {parse_cpu['seconds']:.2f} с; ожидание сети {network:.1f} с (сумма по потокам); "
+        f"пик памяти {crawl_peak:.1f} МБ",
+        f"  calculate_af_column: {af_elapsed:.2f} с, пик памяти {af_peak:.1f} МБ",
+    ]
+
+def bench_crawl(args):
+    sizes = [int(size) for size in args.sizes.split(",")]
+    parsing_copy.extract_admin_hrefs = count_parse_cpu(parsing_copy.extract_admin_hrefs)
+    parsing_copy.extract_last_seen = count_parse_cpu(parsing_copy.extract_last_seen)
+    parsing_copy.configure_concurrency(args.workers, args.per_host or args.workers)
+    parsing_copy.RETRY_BASE_DELAY = args.retry_delay
+    with fake_lichess_server(args) as base_url:
+        parsing_copy.LICHESS_URL = base_url
+        lines = [
+            f"== Обход локальной копии lichess ({args.workers} потоков, задержка {args.latency:g} мс, "
+            f"ошибки {args.error_rate:g}, 429 {args.throttle_rate:g}, лимит {args.rate or 'нет'} запр./с, "
+            f"память: {'tracemalloc' if args.trace_memory else 'пиковый RSS'}) =="
+        ]
+        for clubs in sizes:
+            lines += bench_crawl_size(base_url, clubs, args)
+    report(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры производительности парсера клубов")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--crawl", action="store_true", help="замерить обход клубов на локальной копии lichess")
+    parser.add_argument("--sizes", default="10,1000,50000", help="размеры списков клубов через запятую")
+    parser.add_argument("--workers", type=int, default=parsing_copy.MAX_WORKERS)
+    parser.add_argument("--per-host", type=int, default=0, help="лимит запросов к хосту (0 — равен числу потоков)")
+    parser.add_argument("--rate", type=float, default=0, help="лимит запросов в секунду (0 — без ограничения)")
+    parser.add_argument("--latency", type=float, default=20, help="задержка ответа сервера в миллисекундах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=0.1, help="Retry-After в ответах 429 (секунды)")
+    parser.add_argument("--retry-delay", type=float, default=0.05, help="базовая задержка повтора после ошибки (секунды)")
+    parser.add_argument("--admin-pool", type=int, default=5000, help="число разных админов на все клубы")
+    parser.add_argument("--trace-memory", action="store_true", help="пик памяти каждого этапа через tracemalloc (медленнее)")
+    args = parser.parse_args()
+    if args.crawl:
+        bench_crawl(args)
+    else:
+        bench_extract(args.iterations)
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import os
+import time
+
+from aiogram import Bot, Dispatcher, types
+
+import bench_common
+from bench_common import report
+from fake_telegram_api import make_callback_update, make_message_update
+
+bot_chess_copy = bench_common.import_bot()
+
+USER_ID = 777
+CALLBACK_DATA = [
+    "show_broadcast_template", "return_to_menu", "send_instruction", "return_to_users_list",
+    "users_page:ok:1", "users_search_reset", "users_noop", f"remove_ban:{USER_ID}", f"view_media:{USER_ID}",
+    f"user_select:{USER_ID}", f"set_status:{USER_ID}:✅", "get_next_group", "ban_user",
+]
+
+async def noop(*args, **kwargs):
+    pass
+
+# Прежняя схема: цепочка фильтров-лямбд в порядке регистрации и обработчик медиа для любых сообщений
+def build_legacy_dispatcher(bot):
+    dp = Dispatcher(bot)
+    admin_states = {}
+    # Команды те же, что у бота, в том же порядке
+    for command in ["metrics", "start", "run", "send_groups", "users", "broadcast", "templates", "template"]:
+        dp.register_message_handler(noop, commands=[command])
+    dp.register_message_handler(noop, lambda message: message.text == "Изменить шаблон")
+    dp.register_message_handler(noop, lambda message: message.from_user.id in admin_states and admin_states[message.from_user.id] == "waiting_for_template")
+    for data in ["show_broadcast_template", "return_to_menu", "send_instruction", "return_to_users_list"]:
+        dp.register_callback_query_handler(noop, lambda c, data=data: c.data == data)
+    dp.register_callback_query_handler(noop, lambda c: c.data.startswith("users_page:") or c.data == "users_search_reset")
+    dp.register_callback_query_handler(noop, lambda c: c.data == "users_noop")
+    for prefix in ["remove_ban:", "view_media:", "user_select:", "set_status:"]:
+        dp.register_callback_query_handler(noop, lambda c, prefix=prefix: c.data.startswith(prefix))
+    for data in ["get_next_group", "ban_user"]:
+        dp.register_callback_query_handler(noop, lambda c, data=data: c.data == data)
+    dp.register_message_handler(noop, content_types=types.ContentType.ANY)
+    dp.register_message_handler(noop)
+    # Та же промежуточная обработка, что и у бота, чтобы сравнивать только маршрутизацию
+    dp.middleware.setup(bot_chess_copy.MetricsMiddleware())
+    return dp
+
+# Текущая схема бота: маршрутизаторы настоящие, конечные обработчики заменены заглушками
+def build_router_dispatcher():
+    routers = (bot_chess_copy.route_callback, bot_chess_copy.route_text)
+    for handlers in (bot_chess_copy.dp.message_handlers, bot_chess_copy.dp.callback_query_handlers):
+        for handler_obj in handlers.handlers:
+            if handler_obj.handler not in routers:
+                handler_obj.handler = noop
+    for routes in (bot_chess_copy.callback_routes, bot_chess_copy.TEXT_ROUTES, bot_chess_copy.ADMIN_STATE_ROUTES):
+        for key in routes:
+            routes[key] = noop
+    return bot_chess_copy.dp
+
+def make_updates():
+    photo = make_message_update(USER_ID, "")
+    del photo["message"]["text"]
+    photo["message"]["photo"] = [{"file_id": "photo", "file_unique_id": "photo", "width": 10, "height": 10}]
+    return {
+        "нажатие кнопки": [make_callback_update(USER_ID, data) for data in CALLBACK_DATA],
+        "текст": [make_message_update(USER_ID, "hello"), make_message_update(USER_ID, "Изменить шаблон")],
+        "команда": [make_message_update(USER_ID, "/users")],
+        "фото": [photo],
+    }
+
+# Время обработки одного обновления каждым диспетчером в микросекундах. Диспетчеры
+# прогоняются поочередно короткими сериями и берется лучшая серия каждого, чтобы
+# фоновая нагрузка и ограничение CPU на машине одинаково влияли на обе схемы
+async def measure(dispatchers, updates, iterations, repeats=10):
+    parsed = [types.Update(update_id=i + 1, **update) for i, update in enumerate(updates)]
+    best = [None] * len(dispatchers)
+    for _ in range(repeats):
+        for index, dp in enumerate(dispatchers):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                for update in parsed:
+                    await dp.process_update(update)
+            elapsed = time.perf_counter() - start
+            best[index] = elapsed if best[index] is None else min(best[index], elapsed)
+    return [elapsed / (iterations * len(parsed)) * 1e6 for elapsed in best]
+
+async def bench_routing(iterations):
+    bot = Bot(token=os.environ["BOT_TOKEN"])
+    Bot.set_current(bot)
+    legacy_dp = build_legacy_dispatcher(bot)
+    router_dp = build_router_dispatcher()
+    lines = [f"== Маршрутизация обновлений ({iterations} итераций) =="]
+    for kind, updates in make_updates().items():
+        legacy_us, router_us = await measure([legacy_dp, router_dp], updates, iterations)
+        lines.append(f"{kind}: цепочка фильтров {legacy_us:.1f} мкс, маршрутизатор {router_us:.1f} мкс на обновление")
+    report(lines)
+    await (await bot.get_session()).close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замеры стоимости маршрутизации обновлений")
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+    asyncio.run(bench_routing(args.iterations))
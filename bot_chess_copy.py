@@ -1,13 +1,29 @@
 import asyncio
+import collections
+import contextlib
+import csv
+import functools
+import hashlib
+import heapq
+import itertools
+import json
 import logging
-from aiogram.utils.exceptions import MessageCantBeDeleted
+import threading
+from aiogram.utils.exceptions import ChatNotFound, MessageCantBeDeleted, MessageNotModified, RetryAfter, Unauthorized
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.types import ParseMode, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils import executor
+from aiohttp import web
 from openpyxl import load_workbook
 import os
+import re
+import sqlite3
 import time
 import shutil
+import metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -17,15 +33,50 @@ logging.basicConfig(
 )
 
 # Инициализация бота
-API_TOKEN = ''  # Замените на ваш токен
-bot = Bot(token=API_TOKEN)
+API_TOKEN = os.environ.get("BOT_TOKEN", '')  # Замените на ваш токен или задайте BOT_TOKEN
+# Адрес Bot API; для проверки можно указать локальный fake_telegram_api.py
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+bot = Bot(token=API_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
 dp = Dispatcher(bot)
 
+# Режим работы: "polling" — опрос getUpdates, "webhook" — Telegram присылает обновления
+# на локальный aiohttp-сервер WEBAPP_HOST:WEBAPP_PORT по адресу WEBHOOK_URL
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.environ.get("WEBAPP_PORT", "8080"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+# Публичный адрес, на который Telegram отправляет обновления (обычно https через обратный прокси)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", f"http://{WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+# Сколько секунд при остановке ждать отправки сообщений, уже стоящих в очереди
+SHUTDOWN_DRAIN_TIMEOUT = 5
+# Локальный эндпоинт /metrics в текстовом формате Prometheus (порт 0 — отключить)
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+metrics_subscriptions = {}  # Периодические сводки для администраторов: {admin_id: task}
+
+metrics.describe("bot_handler_seconds", "histogram", "Время обработки обновления (с учетом отправки ответов)")
+metrics.describe("bot_handler_errors_total", "counter", "Исключения в обработчиках")
+metrics.describe("telegram_api_calls_total", "counter", "Вызовы Bot API через исходящую очередь")
+metrics.describe("telegram_api_errors_total", "counter", "Ошибки вызовов Bot API")
+metrics.describe("telegram_api_seconds", "histogram", "Длительность вызова Bot API")
+metrics.describe("bot_queue_depth", "gauge", "Число элементов в очереди")
+metrics.describe("bot_flush_seconds", "histogram", "Длительность записи измененных данных")
+metrics.describe("bot_last_flush_seconds", "gauge", "Длительность последней записи измененных данных")
+metrics.describe("bot_media_save_seconds", "histogram", "Загрузка и сохранение медиа пользователя")
+metrics.describe("bot_process_excel_seconds", "histogram", "Чтение таблицы клубов и формирование групп")
+
 # Файлы для сохранения данных
 PROGRESS_FILE = "user_progress.txt"
 BANS_FILE = "user_bans.txt"
 USERS_FILE = "users.txt"  # Файл для хранения ID пользователей и их статусов
+NICKNAMES_FILE = "nicknames.txt"  # Файл для хранения никнеймов пользователей
+BAN_RESTORES_FILE = "ban_restores.txt"  # Время повторной блокировки после снятия бана администратором
+GROUP_LEASES_FILE = "group_leases.txt"  # Действующие аренды групп: user_id,group_index,срок
 BROADCAST_TEMPLATE_FILE = "broadcast_template.txt"  # Файл для хранения шаблона рассылки
+TEMPLATES_FOLDER = "templates"  # Именованные шаблоны (например, для отдельных турниров): {имя}.txt
+ACTIVE_TEMPLATE_FILE = "active_template.txt"  # Имя шаблона, который видят пользователи (пусто — основной)
+CLUBS_CSV_FILE = "lichess_club_admins.csv"  # Компактная копия таблицы клубов от parsing_copy.py
+GROUPS_PARAMS_FILE = "groups_params.txt"  # Параметры /run, к разбиению которых относится история выдачи
 # Путь к папке для хранения медиа
 MEDIA_FOLDER = "user_media"
 
@@ -33,51 +84,258 @@ MEDIA_FOLDER = "user_media"
 ADMIN_IDS = [1881684121, 5312321185]  # 5312321185 Rus 1881684121
 groups_data = []  # Все группы
 sent_groups = {}  # Отправленные группы: {user_id: [group_index1, group_index2, ...]}
-current_group_index = {}  # Текущая группа для каждого пользователя: {user_id: current_index}
 user_bans = {}  # Блокировки пользователей: {user_id: ban_time}
 users_status = {}  # Статусы пользователей: {user_id: status}
 # Глобальная переменная для хранения никнеймов пользователей
 user_nicknames = {}  # {user_id: nickname}
-# Словарь для временного хранения медиагрупп
+# Повторная блокировка через 24 часа после снятия бана: {user_id: restore_time}
+ban_restore_times = {}
+# Медиагруппы, ожидающие последнего файла: {media_group_id: {"files": [...], "sender_id": ..., "task": ...}}
 media_groups = {}
-# Словарь для отслеживания времени последней отправки медиа
-last_media_time = {}
-# Очередь для отправки сообщений администраторам
+# Пауза после последнего файла альбома, после которой он считается полным (в секундах)
+MEDIA_GROUP_DEBOUNCE = 2
+# Типы сообщений, которые сохраняются как медиа пользователя (см. get_media_file)
+MEDIA_CONTENT_TYPES = [types.ContentType.PHOTO, types.ContentType.DOCUMENT, types.ContentType.VIDEO]
+# Максимум одновременных загрузок файлов одного альбома
+MEDIA_DOWNLOAD_CONCURRENCY = 4
+# Кэш "хэш содержимого -> Telegram file_id" для повторной отправки без загрузки файла
+FILE_ID_CACHE_FILE = os.path.join(MEDIA_FOLDER, "file_ids.json")
+file_id_cache = {}  # {sha1: file_id}
+file_hash_memo = {}  # {(путь, mtime, размер): sha1}
+file_id_cache_lock = threading.Lock()
+# Блокировки, чтобы альбомы одного пользователя не перезаписывали друг друга: {user_id: Lock}
+user_media_locks = {}
+# Куча событий планировщика блокировок: [(время, "expire" | "restore", user_id)]
+ban_schedule = []
+ban_schedule_wakeup = asyncio.Event()
+# Очередь массовых сообщений: (chat_id, текст, медиа, on_done); on_done(chat_id, error) вызывается после отправки
 message_queue = asyncio.Queue()
-
-# Задержка между отправками сообщений (в секундах)
-SEND_DELAY = 1
+# Рассылка всем пользователям: состояние для продолжения после перезапуска и журнал доставки
+BROADCAST_STATE_FILE = "broadcast_state.json"
+BROADCAST_LOG_FILE = "broadcast_log.txt"  # broadcast_id,user_id,status,время
+BROADCAST_PROGRESS_INTERVAL = 5  # как часто обновлять сообщение с прогрессом (в секундах)
+BROADCAST_LOG_FLUSH_INTERVAL = 1  # как часто сбрасывать журнал доставки на диск (в секундах)
+broadcast_task = None
+
+# Файлы с несохраненными изменениями и интервал их записи на диск (в секундах)
+dirty_files = set()
+dirty_rows = {}  # {filename: {user_id, ...} или None — изменена вся таблица}
+FLUSH_INTERVAL = 2
+# Сбросы идут по одному: иначе более старый снимок может записаться поверх нового
+flush_lock = asyncio.Lock()
+flush_task = None
+
+# Хранилище данных: "text" — текстовые файлы, "sqlite" — база DB_FILE (при первом запуске
+# данные переносятся из текстовых файлов)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "text")
+DB_FILE = os.environ.get("DB_FILE", "bot_state.db")
+db_connection = None
+db_lock = threading.Lock()
+
+# Список пользователей для администраторов: страницы по USERS_PAGE_SIZE кнопок, фильтр по статусу
+# и поиск по никнейму. Готовые страницы кэшируются до изменения статусов или никнеймов
+USERS_PAGE_SIZE = 20
+USER_STATUS_FILTERS = {"all": ("Все", None), "ok": ("✅", "✅"), "no": ("❌", "❌"), "none": ("Без статуса", "")}
+users_list_cache = {}  # {(фильтр, поиск, страница): (текст, клавиатура)}
+users_list_views = {}  # Последняя открытая страница администратора: {admin_id: (фильтр, поиск, страница)}
+
+# Кэш шаблонов рассылки: {filename: {"text": ..., "stat_key": ..., "checked": ...}}.
+# Файл проверяется не чаще раза в TEMPLATE_STAT_INTERVAL секунд, поэтому правки файла
+# вручную подхватываются без перезапуска, а нажатия кнопок не обращаются к диску
+TEMPLATE_STAT_INTERVAL = 5
+template_cache = {}
+active_template = ""
+
+# Кэш групп, построенных process_excel: {"stat_key": ..., "digest": ..., "groups": [...]}
+groups_cache = {}
+groups_cache_lock = threading.Lock()
+# Параметры разбиения (размер группы, целевая сумма), по которому выдавались группы. История
+# выдачи хранит номера групп, поэтому при другом разбиении она указала бы на другие клубы.
+# По умолчанию — одна группа на клуб, как до появления параметров /run
+groups_params = (1, None)
+
+# Исходящие запросы: приоритеты (меньше — раньше), число воркеров и лимиты Telegram
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+SEND_WORKERS = 4
+GLOBAL_SEND_RATE = 30  # сообщений в секунду на бота
+CHAT_SEND_RATE = 1  # сообщений в секунду в один чат
+CHAT_SEND_BURST = 3  # короткая серия ответов на одно нажатие отправляется без задержки
+outbound_queue = asyncio.PriorityQueue()
+outbound_sequence = itertools.count()
+global_bucket = [GLOBAL_SEND_RATE, time.monotonic()]  # [токены, время обновления]
+chat_buckets = {}  # {chat_id: [токены, время обновления]}
+outbound_paused_until = 0.0
+# Удаление и правка сообщений не расходуют лимиты отправки сообщений
+UNLIMITED_METHODS = {"delete_message", "edit_message_text"}
+# Запросы в чаты, исчерпавшие лимит, откладываются, а не ждут в воркере (иначе несколько
+# ответов в один чат заняли бы всех воркеров): куча [(время готовности, приоритет, номер, запрос)]
+deferred_outbound = []
+deferred_outbound_wakeup = asyncio.Event()
+deferred_chats = {}  # {chat_id: [число отложенных запросов, время готовности последнего]}
 
 # Создаем папку для медиа, если она не существует
 if not os.path.exists(MEDIA_FOLDER):
     os.makedirs(MEDIA_FOLDER)
 
-async def process_message_queue():
+# Исходящий диспетчер: все запросы к Telegram, связанные с отправкой, проходят через очередь
+# с приоритетами и выполняются несколькими воркерами с учетом лимитов Telegram
+async def outbound(target_chat_id, method, /, *args, priority=PRIORITY_INTERACTIVE, **kwargs):
+    future = asyncio.get_running_loop().create_future()
+    outbound_queue.put_nowait((priority, next(outbound_sequence), target_chat_id, method, args, kwargs, future))
+    return await future
+
+# Обертки над методами бота с той же сигнатурой; чат берется из chat_id или первого аргумента
+def outbound_method(name):
+    async def call(*args, priority=PRIORITY_INTERACTIVE, **kwargs):
+        chat_id = kwargs.get("chat_id", args[0] if args else None)
+        return await outbound(chat_id, getattr(bot, name), *args, priority=priority, **kwargs)
+    return call
+
+send_message = outbound_method("send_message")
+send_document = outbound_method("send_document")
+send_media_group = outbound_method("send_media_group")
+edit_message_text = outbound_method("edit_message_text")
+delete_message = outbound_method("delete_message")
+
+# Token bucket с резервированием: токены могут уйти в минус, тогда вызывающий ждет
+# ровно столько, сколько нужно для восстановления своего токена
+def reserve_token(bucket, rate, capacity):
+    now = time.monotonic()
+    bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate) - 1
+    bucket[1] = now
+    return max(0.0, -bucket[0] / rate)
+
+# Токен чата: 0, если токен есть (он расходуется), иначе время, когда он появится
+def take_chat_token(chat_id):
+    now = time.monotonic()
+    bucket = chat_buckets.setdefault(chat_id, [CHAT_SEND_BURST, now])
+    bucket[0] = min(CHAT_SEND_BURST, bucket[0] + (now - bucket[1]) * CHAT_SEND_RATE)
+    bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        return 0.0
+    return now + (1 - bucket[0]) / CHAT_SEND_RATE
+
+# Откладывание запроса до готовности чата. Пока у чата есть отложенные запросы, новые
+# встают за ними, поэтому ответы в один чат уходят в порядке отправки
+def defer_outbound(item, ready_at):
+    chat_id = item[2]
+    pending = deferred_chats.setdefault(chat_id, [0, ready_at])
+    pending[0] += 1
+    pending[1] = max(pending[1], ready_at)
+    heapq.heappush(deferred_outbound, (pending[1], item[0], item[1], item))
+    if deferred_outbound[0][3] is item:
+        deferred_outbound_wakeup.set()
+
+# Возврат отложенных запросов в очередь по готовности чатов
+async def outbound_scheduler():
     while True:
-        # Получаем сообщение из очереди
-        chat_id, message_text, media = await message_queue.get()
+        now = time.monotonic()
+        while deferred_outbound and deferred_outbound[0][0] <= now:
+            item = heapq.heappop(deferred_outbound)[3]
+            pending = deferred_chats[item[2]]
+            pending[0] -= 1
+            if not pending[0]:
+                del deferred_chats[item[2]]
+            outbound_queue.put_nowait(item)
+            # Когда запрос откладывали, task_done не вызывался: запрос все еще не обработан
+            outbound_queue.task_done()
+        deferred_outbound_wakeup.clear()
+        timeout = deferred_outbound[0][0] - time.monotonic() if deferred_outbound else None
         try:
-            if media:
-                # Если есть медиафайлы, отправляем медиагруппу
-                await bot.send_media_group(chat_id=chat_id, media=media)
-                logging.info(f"Медиагруппа отправлена админу {chat_id}.")
-            else:
-                # Если нет медиафайлов, отправляем текстовое сообщение
-                await bot.send_message(chat_id=chat_id, text=message_text)
-                logging.info(f"Текстовое сообщение отправлено админу {chat_id}.")
+            await asyncio.wait_for(deferred_outbound_wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def wait_for_send_slot(limited):
+    # После RetryAfter Telegram не принимает запросы от бота до конца паузы
+    pause = outbound_paused_until - time.monotonic()
+    if pause > 0:
+        await asyncio.sleep(pause)
+    if limited:
+        delay = reserve_token(global_bucket, GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def outbound_worker():
+    global outbound_paused_until
+    while True:
+        item = await outbound_queue.get()
+        priority, sequence, chat_id, method, args, kwargs, future = item
+        deferred = False
+        try:
+            if future.cancelled():
+                continue
+            limited = method.__name__ not in UNLIMITED_METHODS
+            if limited and chat_id is not None:
+                pending = deferred_chats.get(chat_id)
+                ready_at = pending[1] if pending else take_chat_token(chat_id)
+                if ready_at:
+                    defer_outbound(item, ready_at)
+                    deferred = True
+                    continue
+            await wait_for_send_slot(limited)
+            metrics.inc("telegram_api_calls_total", method=method.__name__)
+            with metrics.timed("telegram_api_seconds", method=method.__name__):
+                result = await method(*args, **kwargs)
+            future.set_result(result)
+        except RetryAfter as e:
+            # Флуд-контроль: приостанавливаем все отправки и возвращаем запрос в очередь на его место
+            metrics.inc("telegram_api_errors_total", method=method.__name__, error="RetryAfter")
+            logging.warning(f"Telegram просит подождать {e.timeout} с (чат {chat_id})")
+            outbound_paused_until = max(outbound_paused_until, time.monotonic() + e.timeout)
+            outbound_queue.put_nowait(item)
         except Exception as e:
-            logging.error(f"Ошибка при отправке сообщения админу {chat_id}: {e}")
+            metrics.inc("telegram_api_errors_total", method=method.__name__, error=type(e).__name__)
+            if not future.done():
+                future.set_exception(e)
         finally:
-            # Добавляем задержку между отправками
-            await asyncio.sleep(SEND_DELAY)
-            # Помечаем задачу как выполненную
-            message_queue.task_done()
+            if not deferred:
+                outbound_queue.task_done()
 
-# Глобальная переменная для отслеживания текущей группы
-global_group_index = 0
+# Массовые сообщения из message_queue отправляются с низким приоритетом, не дожидаясь друг друга
+async def deliver_queued_message(chat_id, message_text, media, on_done):
+    error = None
+    try:
+        if media:
+            # Если есть медиафайлы, отправляем медиагруппу
+            await send_media_group(chat_id=chat_id, media=media, priority=PRIORITY_BULK)
+            logging.info(f"Медиагруппа отправлена в чат {chat_id}.")
+        else:
+            # Если нет медиафайлов, отправляем текстовое сообщение
+            await send_message(chat_id=chat_id, text=message_text, priority=PRIORITY_BULK)
+            logging.info(f"Текстовое сообщение отправлено в чат {chat_id}.")
+    except Exception as e:
+        error = e
+        logging.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
+    finally:
+        # Помечаем задачу как выполненную
+        message_queue.task_done()
+    # При отмене задачи (остановка бота) результат неизвестен, поэтому on_done не вызывается
+    if on_done is not None:
+        on_done(chat_id, error)
 
-def load_data():
-    global sent_groups, current_group_index, user_bans, users_status, global_group_index, user_nicknames
+async def process_message_queue():
+    while True:
+        # Получаем сообщение из очереди
+        chat_id, message_text, media, on_done = await message_queue.get()
+        asyncio.create_task(deliver_queued_message(chat_id, message_text, media, on_done))
+
+# Раздача групп: битовая карта выданных групп, курсор первой невыданной группы и очередь групп,
+# вернувшихся после истечения аренды. Группа выдается пользователю в аренду на GROUP_LEASE_TIME;
+# запрос следующей группы завершает аренду предыдущей, иначе по истечении срока группа
+# возвращается в раздачу
+GROUP_LEASE_TIME = 24 * 60 * 60
+MAX_GROUP_SIZE = 50  # Чтобы список клубов группы поместился в одно сообщение
+assigned_groups = bytearray()
+next_free_group = 0
+returned_groups = collections.deque()
+group_leases = {}  # {user_id: (group_index, expires)}
+lease_schedule = []  # Куча [(expires, user_id, group_index)]
+
+# Загрузка данных из текстовых файлов
+def load_text_data():
     if os.path.exists(PROGRESS_FILE):
         with open(PROGRESS_FILE, "r", encoding="utf-8") as f:
             for line in f:
@@ -91,16 +349,9 @@ def load_data():
                         # Фильтруем только числовые значения для group_indices
                         valid_indices = [int(index) for index in group_indices if index.isdigit()]
                         sent_groups[user_id] = valid_indices
-                        current_group_index[user_id] = len(valid_indices) - 1  # Последний индекс отправленной группы
                     except ValueError as e:
                         logging.error(f"Ошибка при загрузке данных из строки: {line.strip()}. Ошибка: {e}")
                         continue  # Пропускаем некорректные строки
-        # Определяем максимальный индекс группы среди всех пользователей
-        if sent_groups:  # Проверяем, что sent_groups не пуст
-            max_group_index = max((max(indices) for indices in sent_groups.values()), default=0)
-            global_group_index = max_group_index + 1  # Устанавливаем глобальный индекс на следующую группу
-        else:
-            global_group_index = 0  # Если sent_groups пуст, начинаем с нуля
 
     if os.path.exists(BANS_FILE):
         with open(BANS_FILE, "r", encoding="utf-8") as f:
@@ -124,9 +375,31 @@ def load_data():
                     except ValueError as e:
                         logging.error(f"Ошибка при загрузке статуса из строки: {line.strip()}. Ошибка: {e}")
 
+    if os.path.exists(BAN_RESTORES_FILE):
+        with open(BAN_RESTORES_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.strip().split(",")
+                if len(parts) == 2:
+                    user_id, restore_time = parts
+                    try:
+                        ban_restore_times[int(user_id)] = float(restore_time)
+                    except ValueError as e:
+                        logging.error(f"Ошибка при загрузке таймера блокировки из строки: {line.strip()}. Ошибка: {e}")
+
+    if os.path.exists(GROUP_LEASES_FILE):
+        with open(GROUP_LEASES_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.strip().split(",")
+                if len(parts) == 3:
+                    user_id, group_index, expires = parts
+                    try:
+                        group_leases[int(user_id)] = (int(group_index), float(expires))
+                    except ValueError as e:
+                        logging.error(f"Ошибка при загрузке аренды группы из строки: {line.strip()}. Ошибка: {e}")
+
     # Загрузка никнеймов
-    if os.path.exists("nicknames.txt"):
-        with open("nicknames.txt", "r", encoding="utf-8") as f:
+    if os.path.exists(NICKNAMES_FILE):
+        with open(NICKNAMES_FILE, "r", encoding="utf-8") as f:
             for line in f:
                 parts = line.strip().split(":")
                 if len(parts) == 2:  # Убедимся, что строка содержит user_id и nickname
@@ -136,36 +409,359 @@ def load_data():
                     except ValueError as e:
                         logging.error(f"Ошибка при загрузке никнейма из строки: {line.strip()}. Ошибка: {e}")
 
-# Сохранение данных в файлы
-def save_data():
-    with open(PROGRESS_FILE, "w", encoding="utf-8") as f:
-        for user_id, group_indices in sent_groups.items():
-            f.write(f"{user_id},{','.join(map(str, group_indices))}\n")
-    with open(BANS_FILE, "w", encoding="utf-8") as f:
-        for user_id, ban_time in user_bans.items():
-            f.write(f"{user_id},{ban_time}\n")
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        for user_id, status in users_status.items():
-            f.write(f"{user_id},{status}\n")
-    # Сохранение никнеймов
-    with open("nicknames.txt", "w", encoding="utf-8") as f:
-        for user_id, nickname in user_nicknames.items():
-            f.write(f"{user_id}:{nickname}\n")
-
-# Проверка блокировки пользователя
-def is_user_banned(user_id):
-    if user_id in user_bans:
-        # Проверяем, истекло ли время блокировки
-        if time.time() < user_bans[user_id]:
-            return True
+# Загрузка данных из SQLite
+def load_db_data():
+    with db_lock:
+        for user_id, group_index in db_connection.execute("SELECT user_id, group_index FROM progress ORDER BY user_id, position"):
+            sent_groups.setdefault(user_id, []).append(group_index)
+        user_bans.update(db_connection.execute("SELECT user_id, ban_until FROM bans"))
+        users_status.update(db_connection.execute("SELECT user_id, status FROM users"))
+        user_nicknames.update(db_connection.execute("SELECT user_id, nickname FROM nicknames"))
+        ban_restore_times.update(db_connection.execute("SELECT user_id, restore_at FROM ban_restores"))
+        for user_id, group_index, expires in db_connection.execute("SELECT user_id, group_index, expires FROM group_leases"):
+            group_leases[user_id] = (group_index, expires)
+
+def load_data():
+    global db_connection
+    if STORAGE_BACKEND == "sqlite":
+        db_connection = open_db()
+        migrated = db_connection.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()
+        if migrated:
+            load_db_data()
         else:
-            # Удаляем блокировку, если время истекло
-            del user_bans[user_id]
-            users_status[user_id] = ""  # Сбрасываем статус
-            save_data()
-    return False
+            # Однократный перенос данных из текстовых файлов
+            load_text_data()
+            write_db_snapshot({filename: (True, snapshot_rows(filename, None)) for filename in DATA_FILES})
+            with db_lock, db_connection:
+                db_connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+            logging.info(f"Данные перенесены из текстовых файлов в {DB_FILE}")
+    else:
+        load_text_data()
+    load_groups_params()
+
+def load_groups_params():
+    global groups_params
+    if not os.path.exists(GROUPS_PARAMS_FILE):
+        return
+    try:
+        with open(GROUPS_PARAMS_FILE, "r", encoding="utf-8") as f:
+            group_size, target_sum = f.read().strip().split(",")
+        groups_params = (int(group_size), int(target_sum) if target_sum else None)
+    except ValueError as e:
+        logging.error(f"Ошибка при загрузке параметров групп из {GROUPS_PARAMS_FILE}: {e}")
+
+def save_groups_params(params):
+    group_size, target_sum = params
+    write_file_atomic(GROUPS_PARAMS_FILE, f"{group_size},{target_sum or ''}\n")
+
+# Сериализация данных для каждого файла
+def serialize_progress():
+    return "".join(f"{user_id},{','.join(map(str, group_indices))}\n" for user_id, group_indices in sent_groups.items())
+
+def serialize_bans():
+    return "".join(f"{user_id},{ban_time}\n" for user_id, ban_time in user_bans.items())
+
+def serialize_users():
+    return "".join(f"{user_id},{status}\n" for user_id, status in users_status.items())
+
+def serialize_nicknames():
+    return "".join(f"{user_id}:{nickname}\n" for user_id, nickname in user_nicknames.items())
+
+def serialize_ban_restores():
+    return "".join(f"{user_id},{restore_time}\n" for user_id, restore_time in ban_restore_times.items())
+
+def serialize_group_leases():
+    return "".join(f"{user_id},{group_index},{expires}\n" for user_id, (group_index, expires) in group_leases.items())
+
+DATA_FILES = {
+    PROGRESS_FILE: serialize_progress,
+    BANS_FILE: serialize_bans,
+    USERS_FILE: serialize_users,
+    NICKNAMES_FILE: serialize_nicknames,
+    BAN_RESTORES_FILE: serialize_ban_restores,
+    GROUP_LEASES_FILE: serialize_group_leases,
+}
+
+# Таблицы SQLite, соответствующие текстовым файлам
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, status TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bans (user_id INTEGER PRIMARY KEY, ban_until REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS bans_ban_until ON bans (ban_until);
+CREATE TABLE IF NOT EXISTS progress (
+    user_id INTEGER NOT NULL, position INTEGER NOT NULL, group_index INTEGER NOT NULL,
+    PRIMARY KEY (user_id, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS nicknames (user_id INTEGER PRIMARY KEY, nickname TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS nicknames_nickname ON nicknames (nickname);
+CREATE TABLE IF NOT EXISTS ban_restores (user_id INTEGER PRIMARY KEY, restore_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS group_leases (user_id INTEGER PRIMARY KEY, group_index INTEGER NOT NULL, expires REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+DB_TABLES = {
+    PROGRESS_FILE: "progress",
+    BANS_FILE: "bans",
+    USERS_FILE: "users",
+    NICKNAMES_FILE: "nicknames",
+    BAN_RESTORES_FILE: "ban_restores",
+    GROUP_LEASES_FILE: "group_leases",
+}
+
+def open_db():
+    connection = sqlite3.connect(DB_FILE, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(DB_SCHEMA)
+    return connection
+
+def get_state_dict(filename):
+    return {
+        PROGRESS_FILE: sent_groups,
+        BANS_FILE: user_bans,
+        USERS_FILE: users_status,
+        NICKNAMES_FILE: user_nicknames,
+        BAN_RESTORES_FILE: ban_restore_times,
+        GROUP_LEASES_FILE: group_leases,
+    }[filename]
+
+# Снимок строк для записи в SQLite: {user_id: значение или None (строку удалить)}.
+# user_ids=None — все строки таблицы
+def snapshot_rows(filename, user_ids):
+    state = get_state_dict(filename)
+    if user_ids is None:
+        user_ids = state.keys()
+    rows = {}
+    for user_id in user_ids:
+        value = state.get(user_id)
+        rows[user_id] = list(value) if isinstance(value, list) else value
+    return rows
+
+# Запись снимка в SQLite одной транзакцией: {filename: (полная_замена, строки)}
+def write_db_snapshot(snapshot):
+    with db_lock, db_connection:
+        for filename, (full, rows) in snapshot.items():
+            table = DB_TABLES[filename]
+            if full:
+                db_connection.execute(f"DELETE FROM {table}")
+            for user_id, value in rows.items():
+                if value is None:
+                    db_connection.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+                elif filename == PROGRESS_FILE:
+                    # Список групп меняется не только дописыванием: истекшая аренда снимает последнюю
+                    # группу, и новая выдача может оставить длину прежней. Поэтому строки
+                    # пользователя переписываются целиком (их немного)
+                    db_connection.execute("DELETE FROM progress WHERE user_id = ?", (user_id,))
+                    db_connection.executemany(
+                        "INSERT INTO progress (user_id, position, group_index) VALUES (?, ?, ?)",
+                        [(user_id, position, group_index) for position, group_index in enumerate(value)],
+                    )
+                elif filename == GROUP_LEASES_FILE:
+                    db_connection.execute("INSERT OR REPLACE INTO group_leases VALUES (?, ?, ?)", (user_id, *value))
+                else:
+                    db_connection.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?)", (user_id, value))
+
+# Запись через временный файл и переименование: при сбое файл остается целым
+def write_file_atomic(filename, content):
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, filename)
+
+# Пометка данных как измененных; запись выполнит flush_data_periodically.
+# user_id указывает измененную строку (для SQLite), без него перезаписывается вся таблица
+def mark_dirty(*filenames, user_id=None):
+    if USERS_FILE in filenames or NICKNAMES_FILE in filenames:
+        users_list_cache.clear()
+    for filename in filenames:
+        dirty_files.add(filename)
+        rows = dirty_rows.setdefault(filename, set())
+        if rows is None:
+            continue
+        if user_id is None:
+            dirty_rows[filename] = None
+        else:
+            rows.add(user_id)
+
+# Снимок измененных данных и функция для его записи; снимок делается в цикле событий
+def take_snapshot():
+    filenames = list(dirty_files)
+    rows = {filename: dirty_rows.get(filename) for filename in filenames}
+    dirty_files.clear()
+    dirty_rows.clear()
+    if STORAGE_BACKEND == "sqlite":
+        snapshot = {filename: (rows[filename] is None, snapshot_rows(filename, rows[filename])) for filename in filenames}
+        return filenames, write_db_snapshot, snapshot
+    snapshot = {filename: DATA_FILES[filename]() for filename in filenames}
+    return filenames, write_snapshot, snapshot
+
+# Сброс измененных данных: снимок делается в цикле событий, запись — в пуле потоков.
+# За один сброс пишется не больше len(DATA_FILES) файлов, сколько бы ни было нажатий;
+# в SQLite записываются только измененные строки
+async def flush_dirty_data():
+    async with flush_lock:
+        if not dirty_files:
+            return
+        filenames, writer, snapshot = take_snapshot()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, write_snapshot_timed, writer, snapshot)
+        except Exception as e:
+            # Не удалось записать — повторим при следующем сбросе целиком
+            mark_dirty(*filenames)
+            logging.error(f"Ошибка при сохранении данных: {e}")
+
+def write_snapshot(snapshot):
+    for filename, content in snapshot.items():
+        write_file_atomic(filename, content)
+
+# Запись снимка с замером времени (выполняется в пуле потоков)
+def write_snapshot_timed(writer, snapshot):
+    start = time.perf_counter()
+    writer(snapshot)
+    elapsed = time.perf_counter() - start
+    metrics.observe("bot_flush_seconds", elapsed, backend=STORAGE_BACKEND)
+    metrics.set_gauge("bot_last_flush_seconds", elapsed)
+
+async def flush_data_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_dirty_data()
+
+# Проверка блокировки пользователя. Истекшие блокировки снимает ban_scheduler
+def is_user_banned(user_id):
+    return time.time() < user_bans.get(user_id, 0)
+
+# Планировщик блокировок: куча событий (время, тип, user_id). Событие "expire" снимает
+# блокировку, "restore" блокирует снова через 24 часа после снятия бана администратором.
+# Отмененные события не удаляются из кучи, а пропускаются при срабатывании
+def schedule_ban_event(when, kind, user_id):
+    heapq.heappush(ban_schedule, (when, kind, user_id))
+    if ban_schedule[0] == (when, kind, user_id):
+        # Новое событие раньше всех остальных — будим планировщик
+        ban_schedule_wakeup.set()
+
+# Восстановление кучи после запуска из сохраненных блокировок и таймеров
+def rebuild_ban_schedule():
+    ban_schedule.clear()
+    ban_schedule.extend((ban_time, "expire", user_id) for user_id, ban_time in user_bans.items())
+    ban_schedule.extend((restore_time, "restore", user_id) for user_id, restore_time in ban_restore_times.items())
+    heapq.heapify(ban_schedule)
+
+# Событие актуально, только если время совпадает с текущим состоянием пользователя
+def is_ban_event_current(when, kind, user_id):
+    if kind == "expire":
+        return user_bans.get(user_id) == when
+    return ban_restore_times.get(user_id) == when
+
+async def fire_ban_event(kind, user_id):
+    if kind == "expire":
+        # Удаляем блокировку, если время истекло
+        del user_bans[user_id]
+        users_status[user_id] = ""  # Сбрасываем статус
+        mark_dirty(BANS_FILE, USERS_FILE, user_id=user_id)
+    else:
+        del ban_restore_times[user_id]
+        mark_dirty(BAN_RESTORES_FILE, user_id=user_id)
+        await restore_ban_if_inactive(user_id)
+
+async def ban_scheduler():
+    while True:
+        now = time.time()
+        while ban_schedule and ban_schedule[0][0] <= now:
+            when, kind, user_id = heapq.heappop(ban_schedule)
+            if not is_ban_event_current(when, kind, user_id):
+                continue
+            try:
+                await fire_ban_event(kind, user_id)
+            except Exception as e:
+                logging.error(f"Ошибка планировщика блокировок для пользователя {user_id}: {e}")
+        ban_schedule_wakeup.clear()
+        timeout = ban_schedule[0][0] - time.time() if ban_schedule else None
+        try:
+            await asyncio.wait_for(ban_schedule_wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
-# Клавиатура для пользователей
+def is_group_assigned(group_index):
+    return assigned_groups[group_index >> 3] >> (group_index & 7) & 1
+
+def set_group_assigned(group_index, assigned):
+    if assigned:
+        assigned_groups[group_index >> 3] |= 1 << (group_index & 7)
+    else:
+        assigned_groups[group_index >> 3] &= ~(1 << (group_index & 7)) & 0xFF
+
+# Пересборка раздачи для текущего groups_data: выданными считаются все группы из истории sent_groups.
+# Аренды сохраняются вместе с остальными данными, поэтому после перезапуска и повторного /run
+# расписание их возврата восстанавливается; аренды групп, которых больше нет, снимаются
+def reset_group_dispenser():
+    global assigned_groups, next_free_group
+    assigned_groups = bytearray((len(groups_data) + 7) // 8)
+    for group_indices in sent_groups.values():
+        for group_index in group_indices:
+            if group_index < len(groups_data):
+                set_group_assigned(group_index, True)
+    next_free_group = 0
+    returned_groups.clear()
+    lease_schedule.clear()
+    for user_id, (group_index, expires) in list(group_leases.items()):
+        if group_index < len(groups_data):
+            lease_schedule.append((expires, user_id, group_index))
+        else:
+            del group_leases[user_id]
+            mark_dirty(GROUP_LEASES_FILE, user_id=user_id)
+    heapq.heapify(lease_schedule)
+
+# Возврат в раздачу групп с истекшей арендой; группа убирается из истории пользователя
+def expire_group_leases():
+    now = time.time()
+    while lease_schedule and lease_schedule[0][0] <= now:
+        expires, user_id, group_index = heapq.heappop(lease_schedule)
+        if group_leases.get(user_id) != (group_index, expires):
+            continue  # Аренда уже завершена
+        del group_leases[user_id]
+        mark_dirty(GROUP_LEASES_FILE, user_id=user_id)
+        set_group_assigned(group_index, False)
+        returned_groups.append(group_index)
+        # Действующая аренда всегда относится к последней выданной пользователю группе
+        user_groups = sent_groups.get(user_id, [])
+        if user_groups and user_groups[-1] == group_index:
+            user_groups.pop()
+            mark_dirty(PROGRESS_FILE, user_id=user_id)
+        logging.info(f"Аренда группы {group_index} пользователем {user_id} истекла, группа возвращена в раздачу")
+
+# Выдача следующей группы пользователю. Функция не содержит await, поэтому в цикле событий
+# выполняется атомарно: одновременные нажатия не получат одну и ту же группу.
+# Возвращает индекс группы или None, если невыданных групп не осталось
+def claim_group(user_id):
+    global next_free_group
+    # Предыдущая группа пользователя считается обработанной. Аренда завершается до возврата
+    # истекших аренд: иначе просроченная группа пользователя вернулась бы в раздачу и была бы
+    # выдана ему же повторно. Ее запись в lease_schedule пропустится при срабатывании
+    if group_leases.pop(user_id, None):
+        mark_dirty(GROUP_LEASES_FILE, user_id=user_id)
+    expire_group_leases()
+    if returned_groups:
+        group_index = returned_groups.popleft()
+    else:
+        while next_free_group < len(groups_data) and is_group_assigned(next_free_group):
+            next_free_group += 1
+        if next_free_group >= len(groups_data):
+            return None
+        group_index = next_free_group
+        next_free_group += 1
+    set_group_assigned(group_index, True)
+    expires = time.time() + GROUP_LEASE_TIME
+    group_leases[user_id] = (group_index, expires)
+    heapq.heappush(lease_schedule, (expires, user_id, group_index))
+    sent_groups.setdefault(user_id, []).append(group_index)
+    mark_dirty(PROGRESS_FILE, GROUP_LEASES_FILE, user_id=user_id)
+    return group_index
+
+# Клавиатура для пользователей; клавиатуры не меняются после создания, поэтому
+# строятся один раз и переиспользуются
+@functools.lru_cache(maxsize=None)
 def get_user_keyboard():
     keyboard = InlineKeyboardMarkup()
     keyboard.row(
@@ -183,6 +779,7 @@ def get_user_keyboard():
     return keyboard
 
 # Клавиатура для изменения статуса пользователя
+@functools.lru_cache(maxsize=1024)
 def get_admin_keyboard(user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -196,31 +793,117 @@ def get_admin_keyboard(user_id: int) -> InlineKeyboardMarkup:
     ])
 
 # Клавиатура для администраторов
+@functools.lru_cache(maxsize=None)
 def get_admin_panel():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True)  # Используем ReplyKeyboardMarkup
     keyboard.add(KeyboardButton("/run"), KeyboardButton("/send_groups"))
     keyboard.add(KeyboardButton("/users"), KeyboardButton("Изменить шаблон"))
+    keyboard.add(KeyboardButton("/broadcast"), KeyboardButton("/templates"), KeyboardButton("/metrics"))
     return keyboard
 
-# Клавиатура для списка пользователей
-def get_users_list_keyboard():
+# Клавиатура с единственной кнопкой возврата в меню
+@functools.lru_cache(maxsize=None)
+def get_return_to_menu_keyboard():
     keyboard = InlineKeyboardMarkup()
-    for user_id, status in users_status.items():
-        # Получаем никнейм пользователя или используем "ID: {user_id}", если никнейма нет
-        nickname = user_nicknames.get(user_id, f"ID: {user_id}")
-        if nickname.startswith("ID:"):
-            button_text = f"{nickname} | Статус: {status or 'Без статуса'}"
-        else:
-            button_text = f"@{nickname} | Статус: {status or 'Без статуса'}"
-        keyboard.add(InlineKeyboardButton(button_text, callback_data=f"user_select:{user_id}"))
+    keyboard.row(
+        InlineKeyboardButton("Вернуться в меню", callback_data="return_to_menu")
+    )
     return keyboard
 
-# Загрузка шаблона рассылки
-def load_broadcast_template():
-    if os.path.exists(BROADCAST_TEMPLATE_FILE):
-        with open(BROADCAST_TEMPLATE_FILE, "r", encoding="utf-8") as f:
-            return f.read()
-    return (
+# Клавиатура с кнопкой возврата к карточке пользователя
+@functools.lru_cache(maxsize=1024)
+def get_return_to_user_keyboard(user_id):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(
+        InlineKeyboardButton("Вернуться", callback_data=f"user_select:{user_id}")
+    )
+    return keyboard
+
+# Текст кнопки пользователя в списке
+def get_user_button_text(user_id, status):
+    # Получаем никнейм пользователя или используем "ID: {user_id}", если никнейма нет
+    nickname = user_nicknames.get(user_id)
+    if nickname is None:
+        return f"ID: {user_id} | Статус: {status or 'Без статуса'}"
+    return f"@{nickname} | Статус: {status or 'Без статуса'}"
+
+# Страница списка пользователей: (текст сообщения, клавиатура)
+def get_users_list_page(status_filter="all", query="", page=0):
+    key = (status_filter, query, page)
+    if key in users_list_cache:
+        return users_list_cache[key]
+    wanted = USER_STATUS_FILTERS[status_filter][1]
+    query_lower = query.lower()
+    user_ids = [
+        user_id for user_id, status in users_status.items()
+        if (wanted is None or status == wanted)
+        and (not query_lower or query_lower in user_nicknames.get(user_id, str(user_id)).lower())
+    ]
+    pages = max(1, (len(user_ids) + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE)
+    page = min(page, pages - 1)
+
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(*[
+        InlineKeyboardButton(f"• {label}" if code == status_filter else label, callback_data=f"users_page:{code}:0")
+        for code, (label, _) in USER_STATUS_FILTERS.items()
+    ])
+    for user_id in user_ids[page * USERS_PAGE_SIZE:(page + 1) * USERS_PAGE_SIZE]:
+        keyboard.add(InlineKeyboardButton(
+            get_user_button_text(user_id, users_status[user_id]), callback_data=f"user_select:{user_id}"
+        ))
+    if pages > 1:
+        keyboard.row(
+            InlineKeyboardButton("◀", callback_data=f"users_page:{status_filter}:{(page - 1) % pages}"),
+            InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="users_noop"),
+            InlineKeyboardButton("▶", callback_data=f"users_page:{status_filter}:{(page + 1) % pages}")
+        )
+    if query:
+        keyboard.row(InlineKeyboardButton("Сбросить поиск", callback_data="users_search_reset"))
+
+    text = f"Список пользователей ({len(user_ids)}):"
+    if query:
+        text = f"Поиск «{query}», найдено пользователей: {len(user_ids)}"
+    if not query and len(users_status) > USERS_PAGE_SIZE:
+        text += "\nПоиск по никнейму: /users <ник>"
+    users_list_cache[key] = (text, keyboard)
+    return text, keyboard
+
+# Страница, которую администратор открывал последней (или первая страница)
+def get_users_list_view(admin_id):
+    return get_users_list_page(*users_list_views.get(admin_id, ("all", "", 0)))
+
+# Файл шаблона по имени; пустое имя — основной шаблон
+def get_template_file(name):
+    if not name:
+        return BROADCAST_TEMPLATE_FILE
+    return os.path.join(TEMPLATES_FOLDER, f"{name}.txt")
+
+def get_template_stat_key(filename):
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+# Загрузка шаблона рассылки (по умолчанию — активного) из кэша
+def load_broadcast_template(name=None):
+    filename = get_template_file(active_template if name is None else name)
+    entry = template_cache.get(filename)
+    now = time.monotonic()
+    if entry and now - entry["checked"] < TEMPLATE_STAT_INTERVAL:
+        return entry["text"]
+    stat_key = get_template_stat_key(filename)
+    if entry is None or entry["stat_key"] != stat_key:
+        if stat_key is None:
+            text = DEFAULT_BROADCAST_TEMPLATE
+        else:
+            with open(filename, "r", encoding="utf-8") as f:
+                text = f.read()
+        entry = template_cache[filename] = {"text": text, "stat_key": stat_key}
+    entry["checked"] = now
+    return entry["text"]
+
+DEFAULT_BROADCAST_TEMPLATE = (
         "Hello! We invite your university team ([вставить название вуза в скобках]) to participate in the 8th Interuniversity Team Battle, "
         "the largest interuniversity online tournament on Lichess.\n\n"
         "📅 Date & Time: February 23, 2025 – 12:00 UTC\n"
@@ -239,48 +922,218 @@ def load_broadcast_template():
         "Interuniversity Team Battles Coordinator"
     )
 
-# Сохранение шаблона рассылки
-def save_broadcast_template(template_text):
-    with open(BROADCAST_TEMPLATE_FILE, "w", encoding="utf-8") as f:
-        f.write(template_text)
+# Сохранение шаблона рассылки (по умолчанию — активного); кэш обновляется сразу
+def save_broadcast_template(template_text, name=None):
+    filename = get_template_file(active_template if name is None else name)
+    if filename != BROADCAST_TEMPLATE_FILE:
+        os.makedirs(TEMPLATES_FOLDER, exist_ok=True)
+    write_file_atomic(filename, template_text)
+    template_cache[filename] = {"text": template_text, "stat_key": get_template_stat_key(filename), "checked": time.monotonic()}
+
+# Имена сохраненных шаблонов (без основного)
+def list_broadcast_templates():
+    if not os.path.isdir(TEMPLATES_FOLDER):
+        return []
+    return sorted(file_name[:-4] for file_name in os.listdir(TEMPLATES_FOLDER) if file_name.endswith(".txt"))
+
+def load_active_template():
+    global active_template
+    if os.path.exists(ACTIVE_TEMPLATE_FILE):
+        with open(ACTIVE_TEMPLATE_FILE, "r", encoding="utf-8") as f:
+            active_template = f.read().strip()
+
+def set_active_template(name):
+    global active_template
+    active_template = name
+    write_file_atomic(ACTIVE_TEMPLATE_FILE, name)
+
+# Получатели, которым рассылка уже доставлена (или которые заблокировали бота), по журналу
+def load_broadcast_log(broadcast_id):
+    done = {}  # {user_id: status}
+    if os.path.exists(BROADCAST_LOG_FILE):
+        with open(BROADCAST_LOG_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                parts = line.strip().split(",")
+                if len(parts) >= 3 and parts[0] == broadcast_id and parts[2] in ("ok", "blocked"):
+                    done[int(parts[1])] = parts[2]
+    return done
 
-# Обработка Excel-файла и создание групп
-def process_excel():
-    logging.info("Читаем данные из Excel и формируем группы...")
-    filename = 'lichess_club_admins.xlsx'
-    workbook = load_workbook(filename)
-    sheet = workbook.active
-    af_column_index = 32  # AF
+def broadcast_progress_text(progress):
+    sent = progress["ok"] + progress["blocked"] + progress["error"]
+    return (
+        f"Рассылка {progress['id']}: {sent}/{progress['total']}\n"
+        f"Доставлено: {progress['ok']}, бот заблокирован: {progress['blocked']}, ошибок: {progress['error']}"
+    )
+
+# Рассылка через message_queue: каждому получателю одно сообщение, результат пишется в журнал,
+# поэтому после перезапуска рассылка продолжается с недоставленных. Журнал открыт на всю
+# рассылку и сбрасывается на диск раз в BROADCAST_LOG_FLUSH_INTERVAL, а не открывается
+# для каждого получателя
+async def run_broadcast(state):
+    global broadcast_task
+    done = load_broadcast_log(state["id"])
+    pending = [user_id for user_id in state["recipients"] if user_id not in done]
+    progress = {"id": state["id"], "total": len(state["recipients"]), "ok": 0, "blocked": 0, "error": 0}
+    for status in done.values():
+        progress[status] += 1
+    finished = asyncio.Event()
+    remaining = len(pending)
+    log_file = None
+
+    def on_done(chat_id, error):
+        nonlocal remaining
+        if error is None:
+            status = "ok"
+        elif isinstance(error, (Unauthorized, ChatNotFound)):
+            status = "blocked"
+        else:
+            status = "error"
+        progress[status] += 1
+        log_file.write(f"{state['id']},{chat_id},{status},{int(time.time())}\n")
+        remaining -= 1
+        if remaining == 0:
+            # Последняя запись: закрытие сбрасывает журнал на диск
+            log_file.close()
+            finished.set()
+
+    try:
+        status_message = await send_message(state["admin_id"], broadcast_progress_text(progress))
+        if pending:
+            log_file = open(BROADCAST_LOG_FILE, "a", encoding="utf-8")
+        else:
+            finished.set()
+        for user_id in pending:
+            message_queue.put_nowait((user_id, state["text"], None, on_done))
+        last_text = status_message.text
+        last_progress = time.monotonic()
+        while not finished.is_set():
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(finished.wait(), timeout=BROADCAST_LOG_FLUSH_INTERVAL)
+            if not log_file.closed:
+                log_file.flush()
+            if not finished.is_set() and time.monotonic() - last_progress < BROADCAST_PROGRESS_INTERVAL:
+                continue
+            last_progress = time.monotonic()
+            text = broadcast_progress_text(progress)
+            if text != last_text:
+                with contextlib.suppress(MessageNotModified):
+                    await edit_message_text(text, chat_id=state["admin_id"], message_id=status_message.message_id)
+                last_text = text
+        os.remove(BROADCAST_STATE_FILE)
+        await send_message(state["admin_id"], "Рассылка завершена.\n" + broadcast_progress_text(progress))
+        logging.info(f"Рассылка {state['id']} завершена: {progress}")
+    except Exception as e:
+        logging.error(f"Ошибка рассылки {state['id']}: {e}")
+    finally:
+        broadcast_task = None
+
+def start_broadcast(state):
+    global broadcast_task
+    broadcast_task = asyncio.create_task(run_broadcast(state))
+
+# Продолжение рассылки, прерванной перезапуском бота
+def resume_broadcast():
+    if os.path.exists(BROADCAST_STATE_FILE):
+        with open(BROADCAST_STATE_FILE, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        logging.info(f"Продолжаем рассылку {state['id']}")
+        start_broadcast(state)
+
+# Чтение компактной копии таблицы, которую пишет parsing_copy.py
+def load_clubs_csv(filename):
     data = []
-    for row in sheet.iter_rows(min_row=2, values_only=True):
-        club_url = row[0]
-        active_admins = row[af_column_index - 1]
-        data.append((club_url, active_admins))
-    # Сортируем данные по убыванию количества активных администраторов
+    with open(filename, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            data.append((row["club_url"], int(row["active_count"])))
+    return data
+
+# Контрольная сумма файла для проверки, изменилось ли содержимое
+def file_digest(filename):
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Чтение таблицы в режиме read_only: строки читаются потоково, без загрузки всей книги
+def load_clubs_xlsx(filename):
+    workbook = load_workbook(filename, read_only=True)
+    try:
+        sheet = workbook.active
+        af_column_index = 32  # AF
+        data = []
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            club_url = row[0]
+            active_admins = row[af_column_index - 1] if len(row) >= af_column_index else None
+            data.append((club_url, active_admins or 0))
+        return data
+    finally:
+        workbook.close()
+
+# Обработка Excel-файла и создание групп. Вызывается из пула потоков, поэтому
+# результат кэшируется под блокировкой по mtime и контрольной сумме файла.
+# group_size и target_sum передаются в create_groups
+def process_excel(group_size=1, target_sum=None):
+    filename = 'lichess_club_admins.xlsx'
+    # CSV предпочтительнее, если он не старше таблицы (иначе таблицу правили вручную)
+    if os.path.exists(CLUBS_CSV_FILE) and (
+        not os.path.exists(filename) or os.path.getmtime(CLUBS_CSV_FILE) >= os.path.getmtime(filename)
+    ):
+        filename = CLUBS_CSV_FILE
+    with groups_cache_lock:
+        stat = os.stat(filename)
+        stat_key = (filename, stat.st_mtime_ns, stat.st_size)
+        params = (group_size, target_sum)
+        if groups_cache.get("stat_key") == stat_key:
+            logging.info("Файл не изменился, используем прочитанные клубы")
+        else:
+            # mtime мог измениться без изменения содержимого (например, файл скопировали заново)
+            digest = file_digest(filename)
+            if groups_cache.get("digest") == (filename, digest):
+                groups_cache["stat_key"] = stat_key
+                logging.info("Содержимое файла не изменилось, используем прочитанные клубы")
+            else:
+                if filename == CLUBS_CSV_FILE:
+                    logging.info("Читаем данные из CSV...")
+                    data = load_clubs_csv(filename)
+                else:
+                    logging.info("Читаем данные из Excel...")
+                    data = load_clubs_xlsx(filename)
+                groups_cache.clear()
+                groups_cache.update({"stat_key": stat_key, "digest": (filename, digest), "clubs": data})
+        if groups_cache.get("params") != params:
+            logging.info(f"Формируем группы: размер {group_size}, цель {target_sum or 'не задана'}")
+            groups_cache["groups"] = create_groups(groups_cache["clubs"], group_size, target_sum)
+            groups_cache["params"] = params
+        groups = groups_cache["groups"]
+        logging.info(f"Создано {len(groups)} групп")
+        return groups
+
+# Функция для создания групп: клубы распределяются по группам не больше group_size так,
+# чтобы суммы активных администраторов в группах были как можно ближе.
+# Число групп выбирается так, чтобы все клубы поместились и сумма группы не превышала
+# target_sum (если он задан). Жадный алгоритм: клубы по убыванию числа админов, каждый
+# в группу с наименьшей суммой (куча) — O(n log k). Группы возвращаются по убыванию суммы
+def create_groups(data, group_size, target_sum=None):
+    if not data:
+        return []
     data_sorted = sorted(data, key=lambda x: x[1], reverse=True)
-    # Каждая группа — это одна ссылка клуба
-    groups = [[club] for club in data_sorted]
-    logging.info(f"Создано {len(groups)} групп")
+    group_count = -(-len(data_sorted) // group_size)
+    if target_sum:
+        total = sum(admins for _, admins in data_sorted)
+        group_count = max(group_count, min(len(data_sorted), -(-total // target_sum)))
+    groups = [[] for _ in range(group_count)]
+    heap = [(0, group_id) for group_id in range(group_count)]  # (сумма, номер группы), только неполные группы
+    for club_url, admins in data_sorted:
+        current_sum, group_id = heapq.heappop(heap)
+        groups[group_id].append((club_url, admins))
+        if len(groups[group_id]) < group_size:
+            heapq.heappush(heap, (current_sum + admins, group_id))
+    groups.sort(key=lambda group: sum(admins for _, admins in group), reverse=True)
     return groups
 
-# Функция для создания групп
-def create_group(data_sorted, group_size, target_sum):
-    current_group = []
-    current_sum = 0
-    removed_indices = []
-    for i, (club_url, admins) in enumerate(data_sorted):
-        if len(current_group) < group_size and current_sum + admins <= target_sum:
-            current_group.append((club_url, admins))
-            current_sum += admins
-            removed_indices.append(i)
-        if len(current_group) == group_size or current_sum >= target_sum:
-            break
-    data_sorted = [item for i, item in enumerate(data_sorted) if i not in removed_indices]
-    return current_group, data_sorted
-
-# Автоматическое восстановление блокировки через 24 часа
+# Автоматическое восстановление блокировки через 24 часа (вызывается планировщиком)
 async def restore_ban_if_inactive(user_id):
-    await asyncio.sleep(24 * 60 * 60)  # Ждем 24 часа
     if user_id not in user_bans and user_id in users_status:
         # Проверяем, был ли пользователь активен за последние 24 часа
         if is_user_banned(user_id):
@@ -289,140 +1142,387 @@ async def restore_ban_if_inactive(user_id):
         # Блокируем пользователя снова
         user_bans[user_id] = time.time() + 24 * 60 * 60  # Блокировка на 24 часа
         users_status[user_id] = ""  # Сбрасываем статус
-        save_data()
+        mark_dirty(BANS_FILE, USERS_FILE, user_id=user_id)
+        schedule_ban_event(user_bans[user_id], "expire", user_id)
 
         try:
-            await bot.send_message(
+            await send_message(
                 user_id,
                 "Вы были автоматически заблокированы, так как не взаимодействовали с ботом в течение 24 часов."
             )
         except Exception as e:
             logging.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
 
+# Замер времени обработчиков: сообщения подписываются именем обработчика,
+# нажатия кнопок — действием из callback_data
+class MetricsMiddleware(BaseMiddleware):
+    async def on_process_message(self, message, data):
+        data["metrics_handler"] = current_handler.get().__name__
+        data["metrics_start"] = time.perf_counter()
+
+    async def on_process_callback_query(self, callback_query, data):
+        data["metrics_handler"] = (callback_query.data or "").partition(":")[0]
+        data["metrics_start"] = time.perf_counter()
+
+    async def on_post_process_message(self, message, results, data):
+        self.observe(data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self.observe(data)
+
+    @staticmethod
+    def observe(data):
+        if "metrics_start" in data:
+            metrics.observe("bot_handler_seconds", time.perf_counter() - data["metrics_start"], handler=data["metrics_handler"])
+
+dp.middleware.setup(MetricsMiddleware())
+
+# Ошибки обработчиков считаются, затем логируются как и раньше
+@dp.errors_handler()
+async def count_handler_errors(update, exception):
+    metrics.inc("bot_handler_errors_total", error=type(exception).__name__)
+    logging.exception(f"Ошибка при обработке обновления {update.update_id}: {exception}")
+    return True
+
+def update_queue_gauges():
+    metrics.set_gauge("bot_queue_depth", outbound_queue.qsize() + len(deferred_outbound), queue="outbound")
+    metrics.set_gauge("bot_queue_depth", message_queue.qsize(), queue="message")
+    metrics.set_gauge("bot_queue_depth", len(dirty_files), queue="dirty_files")
+
+async def metrics_handler(request):
+    update_queue_gauges()
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# Сводка метрик для администратора
+def format_metrics_summary():
+    update_queue_gauges()
+    lines = ["Обработчики (число, среднее, p50, p95):"]
+    for labels, (count, average, p50, p95) in sorted(metrics.histogram_summary("bot_handler_seconds").items()):
+        lines.append(f"  {dict(labels)['handler']}: {count}, {average * 1000:.0f} мс, ≤{p50 * 1000:.0f} мс, ≤{p95 * 1000:.0f} мс")
+    calls = sum(metrics.counter_values("telegram_api_calls_total").values())
+    errors = metrics.counter_values("telegram_api_errors_total")
+    lines.append(f"Вызовов Bot API: {calls}, ошибок: {sum(errors.values())}")
+    for labels, value in sorted(errors.items()):
+        lines.append(f"  {dict(labels)['method']} {dict(labels)['error']}: {value}")
+    lines.append(
+        f"Очереди: исходящая {outbound_queue.qsize() + len(deferred_outbound)}, рассылка {message_queue.qsize()}, "
+        f"несохраненных файлов {len(dirty_files)}"
+    )
+    last_flush = metrics.gauge_value("bot_last_flush_seconds")
+    if last_flush is not None:
+        lines.append(f"Последняя запись данных: {last_flush * 1000:.1f} мс")
+    for name, title in [("bot_media_save_seconds", "Сохранение медиа"), ("bot_process_excel_seconds", "Формирование групп")]:
+        for count, average, _, p95 in metrics.histogram_summary(name).values():
+            lines.append(f"{title}: {count}, среднее {average:.2f} с, p95 ≤{p95:g} с")
+    return "\n".join(lines)
+
+async def send_metrics_periodically(admin_id, interval):
+    while True:
+        await asyncio.sleep(interval)
+        await send_message(admin_id, format_metrics_summary(), parse_mode=None)
+
+# Команда /metrics [минуты] (для администраторов): сводка метрик; с числом минут сводка
+# присылается периодически, /metrics 0 отключает периодическую сводку
+@dp.message_handler(commands=['metrics'])
+async def show_metrics(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in ADMIN_IDS:
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
+        return
+    args = message.get_args().strip()
+    if args:
+        if not args.isdigit():
+            await send_message(message.chat.id, "Использование: /metrics [интервал в минутах, 0 — отключить]")
+            return
+        task = metrics_subscriptions.pop(user_id, None)
+        if task:
+            task.cancel()
+        if int(args) > 0:
+            metrics_subscriptions[user_id] = asyncio.create_task(send_metrics_periodically(message.chat.id, int(args) * 60))
+            await send_message(message.chat.id, f"Сводка будет приходить каждые {args} мин.")
+        else:
+            await send_message(message.chat.id, "Периодическая сводка отключена.")
+        return
+    await send_message(message.chat.id, format_metrics_summary(), parse_mode=None)
+
+# Маршрутизация нажатий кнопок: callback_data имеет вид "действие:арг1:арг2", обработчик
+# выбирается по действию из словаря и получает аргументы после двоеточия
+callback_routes = {}  # {действие: обработчик}
+
+def callback_route(action):
+    def register(handler):
+        callback_routes[action] = handler
+        return handler
+    return register
+
+@dp.callback_query_handler()
+async def route_callback(callback_query: types.CallbackQuery):
+    remember_nickname(callback_query.from_user)
+    action, _, args = (callback_query.data or "").partition(":")
+    handler = callback_routes.get(action)
+    if handler is None:
+        logging.warning(f"Неизвестная кнопка {callback_query.data!r} от пользователя {callback_query.from_user.id}")
+        await bot.answer_callback_query(callback_query.id)
+        return
+    if args:
+        await handler(callback_query, *args.split(":"))
+    else:
+        await handler(callback_query)
+
+# Обновление никнеймов при взаимодействии с ботом
+def remember_nickname(user):
+    nickname = user.username  # Берем username, если он существует
+    if nickname and user_nicknames.get(user.id) != nickname:  # Добавляем ник только если он существует
+        user_nicknames[user.id] = nickname
+        mark_dirty(NICKNAMES_FILE, user_id=user.id)
+
 # Команда /start
 @dp.message_handler(commands=['start'])
 async def send_welcome(message: types.Message):
     user_id = message.from_user.id
+    remember_nickname(message.from_user)
 
     # Проверяем, является ли пользователь верифицированным
     if user_id not in ADMIN_IDS and user_id not in users_status:
-        await message.reply("У вас нет доступа к этому боту.")
+        await send_message(message.chat.id, "У вас нет доступа к этому боту.", reply_to_message_id=message.message_id)
         return
 
     # Проверяем блокировку пользователя
     if is_user_banned(user_id):
         # Если пользователь заблокирован, отправляем сообщение и завершаем обработку
-        await message.reply("Вы заблокированы. Вернитесь через 24 часа.")
+        await send_message(message.chat.id, "Вы заблокированы. Вернитесь через 24 часа.", reply_to_message_id=message.message_id)
         return
 
     # Логика для администраторов
     if user_id in ADMIN_IDS:
-        await message.reply(
+        await send_message(
+            message.chat.id,
             "Привет, администратор! Вот ваша панель управления:",
+            reply_to_message_id=message.message_id,
             reply_markup=get_admin_panel()
         )
     else:
         # Для обычных пользователей
         keyboard = get_user_keyboard()
-        await message.reply(
+        await send_message(
+            message.chat.id,
             "Привет! Нажмите кнопку ниже, чтобы получить группу.",
+            reply_to_message_id=message.message_id,
             reply_markup=keyboard
         )
 
 # Команда /run (для администраторов)
 @dp.message_handler(commands=['run'])
 async def run_script(message: types.Message):
+    global groups_params
     user_id = message.from_user.id
     if user_id not in ADMIN_IDS:
-        await message.answer("У вас нет прав для выполнения этой команды.")
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
         return
-    await message.answer("Запускаю скрипт... Пожалуйста, подождите.")
+    # /run [размер группы] [целевая сумма активных админов в группе]
+    try:
+        params = [int(arg) for arg in message.get_args().split()]
+        group_size = params[0] if params else 1
+        target_sum = params[1] if len(params) > 1 else None
+        if len(params) > 2 or not 1 <= group_size <= MAX_GROUP_SIZE or (target_sum is not None and target_sum < 1):
+            raise ValueError
+    except ValueError:
+        await send_message(
+            message.chat.id,
+            f"Использование: /run [размер группы до {MAX_GROUP_SIZE}] [целевая сумма активных админов]"
+        )
+        return
+    # Пока есть история выдачи, группы можно только пересобрать с теми же параметрами
+    if (group_size, target_sum) != groups_params and any(sent_groups.values()):
+        current = " ".join(str(param) for param in groups_params if param is not None)
+        await send_message(
+            message.chat.id,
+            f"Группы уже раздаются с параметрами /run {current}. История выдачи хранит номера групп, "
+            f"поэтому при другом разбиении выданными считались бы не те клубы. Выполните /run {current}."
+        )
+        return
+    await send_message(message.chat.id, "Запускаю скрипт... Пожалуйста, подождите.")
     try:
         global groups_data
-        groups_data = process_excel()
-        await message.answer(f"Группы успешно созданы. Всего групп: {len(groups_data)}")
+        # Чтение таблицы выполняется в пуле потоков, чтобы не останавливать обработку других пользователей
+        loop = asyncio.get_running_loop()
+        with metrics.timed("bot_process_excel_seconds"):
+            groups_data = await loop.run_in_executor(None, process_excel, group_size, target_sum)
+        if (group_size, target_sum) != groups_params:
+            groups_params = (group_size, target_sum)
+            await loop.run_in_executor(None, save_groups_params, groups_params)
+        reset_group_dispenser()
+        await send_message(message.chat.id, f"Группы успешно созданы. Всего групп: {len(groups_data)}")
     except Exception as e:
         logging.error(f"Произошла ошибка: {e}")
-        await message.answer(f"Произошла ошибка: {str(e)}", parse_mode=None)
+        await send_message(message.chat.id, f"Произошла ошибка: {str(e)}", parse_mode=None)
 
 # Команда /send_groups (для администраторов)
 @dp.message_handler(commands=['send_groups'])
 async def send_groups(message: types.Message):
     user_id = message.from_user.id
     if user_id not in ADMIN_IDS:
-        await message.answer("У вас нет прав для выполнения этой команды.")
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
         return
     if not groups_data:
-        await message.answer("Группы еще не созданы. Сначала выполните команду /run.")
+        await send_message(message.chat.id, "Группы еще не созданы. Сначала выполните команду /run.")
         return
-    await message.answer("Готово! Пользователи могут начать получать группы.")
+    await send_message(message.chat.id, "Готово! Пользователи могут начать получать группы.")
 
 # Команда /users (для администраторов)
 @dp.message_handler(commands=['users'])
 async def list_users(message: types.Message):
     user_id = message.from_user.id
     if user_id not in ADMIN_IDS:
-        await message.answer("У вас нет прав для выполнения этой команды.")
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
+        return
+    if not users_status:
+        await send_message(message.chat.id, "Нет зарегистрированных пользователей.")
+        return
+    # /users <ник> ищет пользователей по части никнейма
+    users_list_views[user_id] = ("all", message.get_args().strip().lstrip("@"), 0)
+    text, keyboard = get_users_list_view(user_id)
+    await send_message(message.chat.id, text, reply_markup=keyboard)
+
+# Команда /broadcast [текст] (для администраторов): рассылка текста или текущего шаблона всем пользователям.
+# Если команда отправлена ответом на сообщение, рассылается текст этого сообщения
+@dp.message_handler(commands=['broadcast'])
+async def broadcast(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in ADMIN_IDS:
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
+        return
+    if broadcast_task is not None:
+        await send_message(message.chat.id, "Рассылка уже выполняется, дождитесь ее завершения.")
         return
     if not users_status:
-        await message.answer("Нет зарегистрированных пользователей.")
+        await send_message(message.chat.id, "Нет зарегистрированных пользователей.")
         return
-    await message.answer("Список пользователей:", reply_markup=get_users_list_keyboard())
+    text = message.get_args()
+    if not text and message.reply_to_message:
+        text = message.reply_to_message.text
+    if not text:
+        text = load_broadcast_template()
+    state = {
+        "id": str(int(time.time())),
+        "admin_id": message.chat.id,
+        "text": text,
+        "recipients": list(users_status),
+    }
+    write_file_atomic(BROADCAST_STATE_FILE, json.dumps(state, ensure_ascii=False))
+    start_broadcast(state)
 # Словарь для отслеживания состояний администраторов
 admin_states = {}  # {user_id: state}
+# Шаблон, текст которого ждет администратор: {user_id: (имя, выбрать после сохранения)}
+template_edits = {}
 
 # Обработка кнопки "Изменить шаблон"
-@dp.message_handler(lambda message: message.text == "Изменить шаблон")
 async def change_broadcast_template(message: types.Message):
     user_id = message.from_user.id
     if user_id not in ADMIN_IDS:
-        await message.answer("У вас нет прав для выполнения этого действия.")
+        await send_message(message.chat.id, "У вас нет прав для выполнения этого действия.")
         return
     # Переводим администратора в состояние ожидания нового шаблона
     admin_states[user_id] = "waiting_for_template"
-    await message.answer("Пожалуйста, отправьте новый текст шаблона.")
+    template_edits[user_id] = (active_template, False)
+    await send_message(message.chat.id, f"Пожалуйста, отправьте новый текст шаблона «{active_template or 'основной'}».")
+
+# Команда /templates (для администраторов): список шаблонов рассылки
+@dp.message_handler(commands=['templates'])
+async def list_templates(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in ADMIN_IDS:
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
+        return
+    lines = [
+        f"{'• ' if name == active_template else ''}{name or 'основной'}"
+        for name in [""] + list_broadcast_templates()
+    ]
+    await send_message(
+        message.chat.id,
+        "Шаблоны рассылки (• — активный):\n" + "\n".join(lines) + "\n\nВыбрать или создать: /template <имя>, основной: /template",
+        parse_mode=None
+    )
+
+# Команда /template [имя] (для администраторов): выбор шаблона, который видят пользователи.
+# Если шаблона с таким именем еще нет, бот попросит прислать его текст и выберет шаблон
+# только после сохранения текста, чтобы пользователи не получили пустой шаблон
+@dp.message_handler(commands=['template'])
+async def select_template(message: types.Message):
+    user_id = message.from_user.id
+    if user_id not in ADMIN_IDS:
+        await send_message(message.chat.id, "У вас нет прав для выполнения этой команды.")
+        return
+    name = message.get_args().strip()
+    if name == "основной":
+        name = ""
+    if name and not re.fullmatch(r"[\w-]{1,32}", name):
+        await send_message(message.chat.id, "Имя шаблона может содержать только буквы, цифры, _ и - (до 32 символов).")
+        return
+    if name and name not in list_broadcast_templates():
+        admin_states[user_id] = "waiting_for_template"
+        template_edits[user_id] = (name, True)
+        await send_message(
+            message.chat.id,
+            f"Отправьте текст шаблона «{name}». Шаблон будет создан и выбран после сохранения текста, "
+            f"до этого пользователи видят «{active_template or 'основной'}»."
+        )
+        return
+    # Выбор существующего шаблона отменяет ожидание текста нового
+    if admin_states.get(user_id) == "waiting_for_template":
+        del admin_states[user_id]
+        template_edits.pop(user_id, None)
+    set_active_template(name)
+    await send_message(message.chat.id, f"Активный шаблон: «{name or 'основной'}».")
 
 # Обработка нового шаблона
-@dp.message_handler(lambda message: message.from_user.id in admin_states and admin_states[message.from_user.id] == "waiting_for_template")
 async def update_broadcast_template(message: types.Message):
     user_id = message.from_user.id
     new_template = message.text
-    # Сохраняем новый шаблон в файл
-    save_broadcast_template(new_template)
+    name, activate = template_edits.pop(user_id, (active_template, False))
+    # Сохраняем новый шаблон в файл; новый именованный шаблон выбирается только после этого
+    save_broadcast_template(new_template, name)
     # Удаляем состояние администратора
     del admin_states[user_id]
-    await message.answer("Шаблон успешно обновлен!")
+    if activate:
+        set_active_template(name)
+        await send_message(message.chat.id, f"Шаблон «{name}» сохранен и выбран.")
+        return
+    await send_message(message.chat.id, "Шаблон успешно обновлен!")
 
 # Обработка кнопки "Шаблон рассылки"
-@dp.callback_query_handler(lambda c: c.data == "show_broadcast_template")
+@callback_route("show_broadcast_template")
 async def show_broadcast_template(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
     # Загружаем текущий шаблон
     template_text = load_broadcast_template()
-    # Клавиатура с кнопкой возврата
-    keyboard = InlineKeyboardMarkup()
-    keyboard.row(
-        InlineKeyboardButton("Вернуться в меню", callback_data="return_to_menu")
-    )
-    # Отправляем шаблон текста и клавиатуру
-    await bot.send_message(user_id, template_text, reply_markup=keyboard)
+    # Отправляем шаблон текста и клавиатуру с кнопкой возврата
+    await send_message(user_id, template_text, reply_markup=get_return_to_menu_keyboard())
     # Удаляем старое сообщение с кнопками
-    await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
 
 # Обработка кнопки "Вернуться в меню"
-@dp.callback_query_handler(lambda c: c.data == "return_to_menu")
+@callback_route("return_to_menu")
 async def return_to_menu(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
 
     # Отправляем главное меню
     keyboard = get_user_keyboard()
-    await bot.send_message(user_id, "Вы вернулись в главное меню.", reply_markup=keyboard)
+    await send_message(user_id, "Вы вернулись в главное меню.", reply_markup=keyboard)
 
     # Удаляем старое сообщение с кнопками
-    await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
 
 # Обработка кнопки "Инструкция"
-@dp.callback_query_handler(lambda c: c.data == "send_instruction")
+@callback_route("send_instruction")
 async def send_instruction(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
 
@@ -431,28 +1531,29 @@ async def send_instruction(callback_query: types.CallbackQuery):
 
     # Проверяем, существует ли файл
     if not os.path.exists(instruction_file):
-        await bot.send_message(user_id, "Извините, инструкция временно недоступна.")
+        await send_message(user_id, "Извините, инструкция временно недоступна.")
         return
 
     # Клавиатура с кнопкой возврата
-    keyboard = InlineKeyboardMarkup()
-    keyboard.row(
-        InlineKeyboardButton("Вернуться в меню", callback_data="return_to_menu")
-    )
-
-    # Отправляем PDF-файл
-    with open(instruction_file, "rb") as file:
-        await bot.send_document(
+    keyboard = get_return_to_menu_keyboard()
+
+    # Отправляем PDF-файл (по file_id, если он уже загружался)
+    loop = asyncio.get_running_loop()
+    digest = await loop.run_in_executor(None, get_file_hash, instruction_file)
+    with contextlib.ExitStack() as stack:
+        document = file_id_cache.get(digest) or stack.enter_context(open(instruction_file, "rb"))
+        sent_message = await send_document(
             chat_id=user_id,
-            document=file,
+            document=document,
             caption="Инструкция по использованию бота и рассылке.",
             reply_markup=keyboard
         )
+    remember_file_ids([digest], [sent_message])
 
     # Удаляем старое сообщение с кнопками
-    await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
 
-@dp.callback_query_handler(lambda c: c.data == "return_to_users_list")
+@callback_route("return_to_users_list")
 async def return_to_users_list(callback_query: types.CallbackQuery):
     admin_id = callback_query.from_user.id
 
@@ -461,20 +1562,49 @@ async def return_to_users_list(callback_query: types.CallbackQuery):
         return
 
     # Удаляем старое сообщение
-    await bot.delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
+
+    # Отправляем страницу списка, которую администратор открывал последней
+    text, keyboard = get_users_list_view(admin_id)
+    await send_message(admin_id, text, reply_markup=keyboard)
+
+# Переключение страниц и фильтра списка пользователей
+# Без аргументов (кнопка "Сбросить поиск") открывается первая страница без поиска
+@callback_route("users_page")
+@callback_route("users_search_reset")
+async def switch_users_page(callback_query: types.CallbackQuery, status_filter=None, page=0):
+    admin_id = callback_query.from_user.id
+    if admin_id not in ADMIN_IDS:
+        await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этого действия.")
+        return
+    current_filter, query, _ = users_list_views.get(admin_id, ("all", "", 0))
+    if status_filter is None:
+        status_filter, query = current_filter, ""
+    page = int(page)
+    users_list_views[admin_id] = (status_filter, query, page)
+    text, keyboard = get_users_list_page(status_filter, query, page)
+    await bot.answer_callback_query(callback_query.id)
+    with contextlib.suppress(MessageNotModified):
+        await edit_message_text(
+            text,
+            chat_id=admin_id,
+            message_id=callback_query.message.message_id,
+            reply_markup=keyboard
+        )
 
-    # Отправляем список пользователей
-    await bot.send_message(admin_id, "Список пользователей:", reply_markup=get_users_list_keyboard())
+# Кнопка с номером страницы ничего не делает
+@callback_route("users_noop")
+async def users_noop(callback_query: types.CallbackQuery):
+    await bot.answer_callback_query(callback_query.id)
 
 # Обработка кнопки "Снять бан"
-@dp.callback_query_handler(lambda c: c.data.startswith("remove_ban:"))
-async def remove_ban(callback_query: types.CallbackQuery):
+@callback_route("remove_ban")
+async def remove_ban(callback_query: types.CallbackQuery, user_id):
     admin_id = callback_query.from_user.id
     if admin_id not in ADMIN_IDS:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этого действия.")
         return
     
-    _, user_id = callback_query.data.split(":")
     user_id = int(user_id)
     
     # Проверяем, заблокирован ли пользователь
@@ -482,13 +1612,15 @@ async def remove_ban(callback_query: types.CallbackQuery):
         await bot.answer_callback_query(callback_query.id, "Пользователь не заблокирован.")
         return
     
-    # Снимаем блокировку
+    # Снимаем блокировку и запускаем таймер на 24 часа
     del user_bans[user_id]
-    save_data()
+    ban_restore_times[user_id] = time.time() + 24 * 60 * 60
+    mark_dirty(BANS_FILE, BAN_RESTORES_FILE, user_id=user_id)
+    schedule_ban_event(ban_restore_times[user_id], "restore", user_id)
     
     # Отправляем уведомление пользователю
     try:
-        await bot.send_message(
+        await send_message(
             user_id,
             "Администратор снял вашу блокировку. Вы можете продолжить получать группы.",
             reply_markup=get_user_keyboard()
@@ -499,72 +1631,68 @@ async def remove_ban(callback_query: types.CallbackQuery):
         return
     
     # Удаляем старое сообщение
-    await bot.delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
     
     # Отправляем новое сообщение с подтверждением и кнопкой возврата
-    await bot.send_message(
+    await send_message(
         chat_id=admin_id,
         text=f"Блокировка пользователя {user_id} успешно снята.",
         reply_markup=get_admin_keyboard(user_id)
     )
-    
-    # Запускаем таймер на 24 часа
-    asyncio.create_task(restore_ban_if_inactive(user_id))
 
 # Обработка кнопки "Просмотреть медиа"
-@dp.callback_query_handler(lambda c: c.data.startswith("view_media:"))
-async def view_media(callback_query: types.CallbackQuery):
+@callback_route("view_media")
+async def view_media(callback_query: types.CallbackQuery, user_id):
     admin_id = callback_query.from_user.id
-    _, user_id = callback_query.data.split(":")
     user_id = int(user_id)
 
     # Путь к папке пользователя
     user_folder = os.path.join(MEDIA_FOLDER, str(user_id))
 
     if os.path.exists(user_folder):
-        # Формируем список медиафайлов
+        # Формируем список медиафайлов: (путь, тип InputMedia)
         media_files = []
-        for file_name in os.listdir(user_folder):
+        for file_name in sorted(os.listdir(user_folder)):
             file_path = os.path.join(user_folder, file_name)
             if file_name.endswith(".jpg"):
-                media_files.append(types.InputMediaPhoto(open(file_path, "rb")))
+                media_files.append((file_path, types.InputMediaPhoto))
             elif file_name.endswith(".doc"):
-                media_files.append(types.InputMediaDocument(open(file_path, "rb")))
+                media_files.append((file_path, types.InputMediaDocument))
             elif file_name.endswith(".mp4"):
-                media_files.append(types.InputMediaVideo(open(file_path, "rb")))
+                media_files.append((file_path, types.InputMediaVideo))
 
         # Разделяем медиафайлы на группы по 10 элементов
-        media_groups = [media_files[i:i + 10] for i in range(0, len(media_files), 10)]
-
-        if media_groups:
-            keyboard = InlineKeyboardMarkup()
-            keyboard.row(
-                InlineKeyboardButton("Вернуться", callback_data=f"user_select:{user_id}")
-            )
-
-            # Отправляем каждую группу медиа
-            for group in media_groups:
-                await bot.send_media_group(chat_id=admin_id, media=group)
+        media_chunks = [media_files[i:i + 10] for i in range(0, len(media_files), 10)]
+
+        if media_chunks:
+            keyboard = get_return_to_user_keyboard(user_id)
+
+            # Отправляем каждую группу медиа; уже загруженные файлы отправляются по file_id
+            loop = asyncio.get_running_loop()
+            for group in media_chunks:
+                digests = await loop.run_in_executor(None, lambda: [get_file_hash(path) for path, _ in group])
+                with contextlib.ExitStack() as stack:
+                    media = []
+                    for (file_path, media_type), digest in zip(group, digests):
+                        file_id = file_id_cache.get(digest)
+                        media.append(media_type(file_id or stack.enter_context(open(file_path, "rb"))))
+                    messages = await send_media_group(chat_id=admin_id, media=media)
+                remember_file_ids(digests, messages)
 
             # Отправляем сообщение после всех медиа
-            await bot.send_message(chat_id=admin_id, text="Медиа пользователя:", reply_markup=keyboard)
+            await send_message(chat_id=admin_id, text="Медиа пользователя:", reply_markup=keyboard)
         else:
-            await bot.send_message(chat_id=admin_id, text="У пользователя нет медиа.", reply_markup=get_admin_keyboard(user_id))
+            await send_message(chat_id=admin_id, text="У пользователя нет медиа.", reply_markup=get_admin_keyboard(user_id))
     else:
         # Если папка не существует, отправляем сообщение об этом
-        keyboard = InlineKeyboardMarkup()
-        keyboard.row(
-            InlineKeyboardButton("Вернуться", callback_data=f"user_select:{user_id}")
-        )
-        await bot.send_message(chat_id=admin_id, text="У пользователя нет медиа.", reply_markup=keyboard)
+        await send_message(chat_id=admin_id, text="У пользователя нет медиа.", reply_markup=get_return_to_user_keyboard(user_id))
 
 # Обработка выбора пользователя
-@dp.callback_query_handler(lambda c: c.data.startswith("user_select:"))
-async def select_user(callback_query: types.CallbackQuery):
+@callback_route("user_select")
+async def select_user(callback_query: types.CallbackQuery, user_id):
     admin_id = callback_query.from_user.id
-    _, user_id = callback_query.data.split(":")
     user_id = int(user_id)
-    await bot.edit_message_text(
+    await edit_message_text(
         chat_id=admin_id,
         message_id=callback_query.message.message_id,
         text=f"Выбран пользователь ID: {user_id}. Измените его статус:",
@@ -572,32 +1700,30 @@ async def select_user(callback_query: types.CallbackQuery):
     )
 
 # Изменение статуса пользователя
-@dp.callback_query_handler(lambda c: c.data.startswith("set_status:"))
-async def set_user_status(callback_query: types.CallbackQuery):
+@callback_route("set_status")
+async def set_user_status(callback_query: types.CallbackQuery, user_id, status):
     admin_id = callback_query.from_user.id
     if admin_id not in ADMIN_IDS:
         await bot.answer_callback_query(callback_query.id, "У вас нет прав для выполнения этого действия.")
         return
     
-    _, user_id, status = callback_query.data.split(":")
     user_id = int(user_id)
     users_status[user_id] = status
-    save_data()
+    mark_dirty(USERS_FILE, user_id=user_id)
     
     # Удаляем старое сообщение
-    await bot.delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=admin_id, message_id=callback_query.message.message_id)
     
     # Отправляем новое сообщение с обновлённым статусом и кнопкой возврата
-    await bot.send_message(
+    await send_message(
         chat_id=admin_id,
         text=f"Статус пользователя {user_id} изменен на: {status or 'Без статуса'}",
         reply_markup=get_admin_keyboard(user_id)
     )
 
 # Обработка кнопки "Получить следующую группу"
-@dp.callback_query_handler(lambda c: c.data == "get_next_group")
+@callback_route("get_next_group")
 async def get_next_group(callback_query: types.CallbackQuery):
-    global global_group_index  # Используем глобальный счетчик
     user_id = callback_query.from_user.id
 
     # Проверяем, есть ли группы для отправки
@@ -605,43 +1731,27 @@ async def get_next_group(callback_query: types.CallbackQuery):
         await bot.answer_callback_query(callback_query.id, "Группы еще не созданы. Сначала выполните команду /run.")
         return
 
-    # Получаем индекс текущей группы для пользователя
-    if user_id in current_group_index:
-        group_index = current_group_index[user_id] + 1  # Начинаем со следующей группы
-    else:
-        group_index = global_group_index  # Если пользователь новый, используем глобальный индекс
-
-    # Проверяем, остались ли группы для отправкиs
-    if group_index >= len(groups_data):
-        group_index = 0  # Сбрасываем счетчик, если достигнут конец списка групп
-        await bot.answer_callback_query(callback_query.id, "Группы закончились. Начинаем сначала.")
+    # Выдаем группу до первого await, чтобы ее не получил кто-то еще
+    group_index = claim_group(user_id)
+    if group_index is None:
+        await bot.answer_callback_query(callback_query.id, "Все группы уже розданы.")
+        return
 
     # Получаем группу
     group = groups_data[group_index]
 
-    # Формируем сообщение с информацией о группе
-    club_url, active_admins = group[0]
-    group_message = f"{club_url} ({active_admins} активных админов)"
-    await bot.send_message(user_id, f"Ваша группа:\n{group_message}")
-
-    # Обновляем данные о отправленных группах
-    if user_id not in sent_groups:
-        sent_groups[user_id] = []
-    sent_groups[user_id].append(group_index)
-    current_group_index[user_id] = group_index  # Обновляем текущий индекс для пользователя
-    save_data()
-
-    # Увеличиваем глобальный счетчик для следующего пользователя
-    global_group_index = max(global_group_index, group_index + 1)
+    # Формируем сообщение со всеми клубами группы
+    group_message = "\n".join(f"{club_url} ({active_admins} активных админов)" for club_url, active_admins in group)
+    await send_message(user_id, f"Ваша группа:\n{group_message}", disable_web_page_preview=len(group) > 1)
 
     # Удаляем старое сообщение с кнопкой
-    await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+    await delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
 
     # Отправляем новую клавиатуру
-    await bot.send_message(user_id, "Что дальше?", reply_markup=get_user_keyboard())
+    await send_message(user_id, "Что дальше?", reply_markup=get_user_keyboard())
 
 # Обработка кнопки "Получил бан"
-@dp.callback_query_handler(lambda c: c.data == "ban_user")
+@callback_route("ban_user")
 async def ban_user(callback_query: types.CallbackQuery):
     user_id = callback_query.from_user.id
 
@@ -652,7 +1762,7 @@ async def ban_user(callback_query: types.CallbackQuery):
 
     try:
         # Удаляем старое сообщение с кнопкой
-        await bot.delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
+        await delete_message(chat_id=user_id, message_id=callback_query.message.message_id)
     except MessageCantBeDeleted:
         # Логируем ошибку, но продолжаем выполнение
         logging.warning(f"Не удалось удалить сообщение для пользователя {user_id}. Сообщение старше 48 часов или имеет другие ограничения.")
@@ -661,109 +1771,192 @@ async def ban_user(callback_query: types.CallbackQuery):
     ban_time = time.time() + 24 * 60 * 60  # 24 часа
     user_bans[user_id] = ban_time
     users_status[user_id] = ""  # Сбрасываем статус
-    save_data()
-
-    await bot.send_message(user_id, "Вы заблокированы. Вернитесь через 24 часа.")
+    mark_dirty(BANS_FILE, USERS_FILE, user_id=user_id)
+    schedule_ban_event(ban_time, "expire", user_id)
 
-# Словарь для временного хранения медиагрупп
-media_groups = {}
-# Словарь для отслеживания обработанных медиагрупп
-processed_media_groups = {}
-# Блокировка для предотвращения состояния гонки
-media_groups_lock = asyncio.Lock()
+    await send_message(user_id, "Вы заблокированы. Вернитесь через 24 часа.")
 
-# Обработка медиагрупп
-@dp.message_handler(content_types=types.ContentType.ANY)
-async def handle_media(message: types.Message):
-    user_id = message.from_user.id
-    username = message.from_user.username or "Пользователь"
+# Хэш содержимого файла; повторно файл читается, только если изменились mtime или размер
+def get_file_hash(file_path):
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    if key not in file_hash_memo:
+        file_hash_memo[key] = file_digest(file_path)
+    return file_hash_memo[key]
 
-    # Путь к папке пользователя
+def load_file_id_cache():
+    if os.path.exists(FILE_ID_CACHE_FILE):
+        try:
+            with open(FILE_ID_CACHE_FILE, "r", encoding="utf-8") as f:
+                file_id_cache.update(json.load(f))
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось загрузить кэш file_id: {e}")
+
+def save_file_id_cache(content):
+    with file_id_cache_lock:
+        write_file_atomic(FILE_ID_CACHE_FILE, content)
+
+# Запоминаем file_id для хэшей файлов: из отправленных ботом сообщений или переданные явно
+def remember_file_ids(digests, messages=None, file_ids=None):
+    if file_ids is None:
+        media_files = [get_media_file(message) for message in messages]
+        file_ids = [media_file[0] if media_file else None for media_file in media_files]
+    updated = False
+    for digest, file_id in zip(digests, file_ids):
+        if file_id and digest not in file_id_cache:
+            file_id_cache[digest] = file_id
+            updated = True
+    if updated:
+        content = json.dumps(file_id_cache, ensure_ascii=False)
+        asyncio.get_running_loop().run_in_executor(None, save_file_id_cache, content)
+
+# Файл из сообщения: (file_id, расширение) или None, если медиа нет
+def get_media_file(message):
+    if message.photo:
+        return message.photo[-1].file_id, ".jpg"
+    if message.document:
+        return message.document.file_id, ".doc"
+    if message.video:
+        return message.video.file_id, ".mp4"
+    return None
+
+# Замена папки пользователя новой: старая папка переименовывается и удаляется,
+# так что в папке пользователя никогда не бывает смеси старых и новых файлов
+def swap_media_folder(user_folder, new_folder):
+    old_folder = None
+    if os.path.exists(user_folder):
+        old_folder = f"{new_folder}.old"
+        os.rename(user_folder, old_folder)
+    os.rename(new_folder, user_folder)
+    if old_folder:
+        shutil.rmtree(old_folder, ignore_errors=True)
+
+# Сохранение медиа пользователя: все файлы скачиваются параллельно во временную папку,
+# которая затем заменяет старую. Загрузки одного пользователя выполняются по очереди
+async def save_user_media(user_id, messages):
+    files = [media_file for media_file in map(get_media_file, messages) if media_file]
+    if not files:
+        return
     user_folder = os.path.join(MEDIA_FOLDER, str(user_id))
+    tmp_folder = os.path.join(MEDIA_FOLDER, f".tmp_{user_id}_{time.time_ns()}")
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MEDIA_DOWNLOAD_CONCURRENCY)
 
-    # Если это часть медиагруппы
-    if message.media_group_id:
-        media_group_id = message.media_group_id
-
-        # Создаем запись для медиагруппы, если её ещё нет
-        if media_group_id not in media_groups:
-            media_groups[media_group_id] = {
-                "files": [],
-                "sender_id": user_id,
-                "username": username,
-                "timestamp": time.time()
-            }
-
-        # Добавляем файл в медиагруппу
-        media_groups[media_group_id]["files"].append(message)
-
-        # Ожидаем завершения медиагруппы (например, 5 секунд после последнего файла)
-        await asyncio.sleep(5)
-
-        # Проверяем, завершена ли медиагруппа
-        if media_group_id in media_groups and time.time() - media_groups[media_group_id]["timestamp"] > 5:
-            files = media_groups[media_group_id]["files"]
-
-            # Удаляем старые медиа, если они существуют
-            if os.path.exists(user_folder):
-                try:
-                    shutil.rmtree(user_folder)
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении старых файлов: {e}")
-
-            os.makedirs(user_folder, exist_ok=True)
-
-            # Сохраняем новые медиа
-            for file in files:
-                file_path = None
-                if file.photo:
-                    file_id = file.photo[-1].file_id
-                    file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.jpg"))
-                elif file.document:
-                    file_id = file.document.file_id
-                    file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.doc"))
-                elif file.video:
-                    file_id = file.video.file_id
-                    file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.mp4"))
-
-            # Удаляем медиагруппу из временного словаря
-            del media_groups[media_group_id]
+    async def download(file_id, extension):
+        async with semaphore:
+            await bot.download_file_by_id(file_id, destination=os.path.join(tmp_folder, f"{file_id}{extension}"))
 
-    else:
-        # Если это отдельный файл, удаляем старые медиа и сохраняем новый файл
-        if os.path.exists(user_folder):
+    async with user_media_locks.setdefault(user_id, asyncio.Lock()):
+        with metrics.timed("bot_media_save_seconds"):
+            await loop.run_in_executor(None, os.makedirs, tmp_folder)
             try:
-                shutil.rmtree(user_folder)
+                await asyncio.gather(*(download(file_id, extension) for file_id, extension in files))
+                await loop.run_in_executor(None, swap_media_folder, user_folder, tmp_folder)
+                # Запоминаем file_id, полученные от пользователя, чтобы просмотр медиа не загружал файлы заново
+                digests = await loop.run_in_executor(
+                    None, lambda: [get_file_hash(os.path.join(user_folder, f"{file_id}{extension}")) for file_id, extension in files]
+                )
+                remember_file_ids(digests, file_ids=[file_id for file_id, _ in files])
             except Exception as e:
-                logging.error(f"Ошибка при удалении старых файлов: {e}")
-
-        os.makedirs(user_folder, exist_ok=True)
+                logging.error(f"Ошибка при сохранении медиа пользователя {user_id}: {e}")
+                await loop.run_in_executor(None, functools.partial(shutil.rmtree, tmp_folder, ignore_errors=True))
+                return
+    logging.info(f"Сохранено {len(files)} медиафайлов пользователя {user_id}")
 
-        file_path = None
-        if message.photo:
-            file_id = message.photo[-1].file_id
-            file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.jpg"))
-        elif message.document:
-            file_id = message.document.file_id
-            file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.doc"))
-        elif message.video:
-            file_id = message.video.file_id
-            file_path = await bot.download_file_by_id(file_id, destination=os.path.join(user_folder, f"{file_id}.mp4"))
+# Завершение медиагруппы после паузы; новый файл альбома перезапускает ожидание
+async def finalize_media_group(media_group_id):
+    await asyncio.sleep(MEDIA_GROUP_DEBOUNCE)
+    media_group = media_groups.pop(media_group_id)
+    await save_user_media(media_group["sender_id"], media_group["files"])
 
-# Обновление никнеймов при взаимодействии с ботом
-@dp.message_handler()
-async def update_user_nickname(message: types.Message):
+# Обработка медиагрупп
+@dp.message_handler(content_types=MEDIA_CONTENT_TYPES)
+async def handle_media(message: types.Message):
     user_id = message.from_user.id
-    nickname = message.from_user.username  # Берем username, если он существует
-    if nickname:  # Добавляем ник только если он существует
-        user_nicknames[user_id] = nickname
+    remember_nickname(message.from_user)
+
+    # Если это отдельный файл, сразу заменяем им старые медиа
+    if not message.media_group_id:
+        await save_user_media(user_id, [message])
+        return
+
+    # Файлы альбома приходят отдельными сообщениями: собираем их и ждем паузы после последнего
+    media_group = media_groups.setdefault(message.media_group_id, {"files": [], "sender_id": user_id, "task": None})
+    media_group["files"].append(message)
+    if media_group["task"]:
+        media_group["task"].cancel()
+    media_group["task"] = asyncio.create_task(finalize_media_group(message.media_group_id))
+
+# Текстовые сообщения (кроме команд): кнопки панели администратора по точному тексту,
+# затем ожидаемый ввод администратора по его состоянию
+TEXT_ROUTES = {
+    "Изменить шаблон": change_broadcast_template,
+}
+ADMIN_STATE_ROUTES = {
+    "waiting_for_template": update_broadcast_template,
+}
+
+@dp.message_handler(content_types=types.ContentType.TEXT)
+async def route_text(message: types.Message):
+    remember_nickname(message.from_user)
+    handler = TEXT_ROUTES.get(message.text) or ADMIN_STATE_ROUTES.get(admin_states.get(message.from_user.id))
+    if handler:
+        await handler(message)
 
 async def on_startup(dp):
+    global flush_task
     # Запускаем обработку очереди сообщений как фоновую задачу
     asyncio.create_task(process_message_queue())
+    # Периодическая запись измененных данных на диск
+    flush_task = asyncio.create_task(flush_data_periodically())
+    # Воркеры исходящих сообщений
+    for _ in range(SEND_WORKERS):
+        asyncio.create_task(outbound_worker())
+    asyncio.create_task(outbound_scheduler())
+    # Снятие и восстановление блокировок по расписанию
+    rebuild_ban_schedule()
+    asyncio.create_task(ban_scheduler())
+    # Незавершенная рассылка продолжается с того места, где остановилась
+    resume_broadcast()
+    if METRICS_PORT:
+        await start_metrics_server()
+    if BOT_MODE == "webhook":
+        # Обновления, пришедшие пока бот был остановлен, Telegram доставит после установки вебхука
+        await bot.set_webhook(WEBHOOK_URL, drop_pending_updates=False)
+        logging.info(f"Вебхук установлен: {WEBHOOK_URL}")
+
+async def on_shutdown(dp):
+    # Даем воркерам отправить уже поставленные в очередь ответы; вебхук не удаляем,
+    # чтобы Telegram сохранил обновления до следующего запуска
+    with contextlib.suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(outbound_queue.join(), timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    # Дожидаемся текущего сброса и останавливаем периодический, затем записываем
+    # все несохраненные изменения: итоговый снимок записывается последним
+    async with flush_lock:
+        if flush_task is not None:
+            flush_task.cancel()
+        if dirty_files:
+            _, writer, snapshot = take_snapshot()
+            writer(snapshot)
+    if db_connection is not None:
+        db_connection.close()
 
 # Запуск бота
 if __name__ == '__main__':
     logging.info("Бот запущен")
     load_data()
-    executor.start_polling(dp, skip_updates=True, on_startup=on_startup)
+    load_file_id_cache()
+    load_active_template()
+    # Обновления, накопившиеся за время остановки, обрабатываются, а не пропускаются
+    if BOT_MODE == "webhook":
+        executor.start_webhook(
+            dispatcher=dp,
+            webhook_path=WEBHOOK_PATH,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown,
+            skip_updates=False,
+            host=WEBAPP_HOST,
+            port=WEBAPP_PORT,
+        )
+    else:
+        executor.start_polling(dp, skip_updates=False, on_startup=on_startup, on_shutdown=on_shutdown)
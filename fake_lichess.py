@@ -0,0 +1,117 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Локальная замена lichess.org для офлайн-замеров парсера:
+#   python fake_lichess.py --port 8082 --latency 50 --error-rate 0.01 --throttle-rate 0.01
+# Страницы клубов (/team/<имя>) и профилей (/@/<ник>) собираются из сохраненных страниц
+# bench_fixtures: у каждого клуба свой детерминированный набор админов из общего пула,
+# у каждого админа — свое время последнего визита. /fake/stats возвращает число ответов по кодам.
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_fixtures")
+LEADERS_PATTERN = re.compile(r'(<p class="team-show__meta__leaders"><strong>Team leaders</strong>: ).*?(</p>)', re.DOTALL)
+LAST_SEEN_PATTERN = re.compile(r'datetime="[^"]*"')
+
+state = {
+    "latency": 0.0,  # Задержка каждого ответа (в секундах)
+    "error_rate": 0.0,  # Доля ответов 503
+    "throttle_rate": 0.0,  # Доля ответов 429
+    "retry_after": 1.0,  # Значение Retry-After в ответах 429
+    "admin_pool": 5000,  # Сколько разных админов на все клубы
+    "max_admins": 6,  # Максимум админов в одном клубе
+}
+status_counts = {}  # {код ответа: число}
+stats_lock = threading.Lock()
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "r", encoding="utf-8") as f:
+        return f.read()
+
+CLUB_TEMPLATE = LEADERS_PATTERN.sub(r"\1{leaders}\2", load_fixture("club.html").replace("{", "{{").replace("}", "}}"), count=1)
+PROFILE_TEMPLATE = LAST_SEEN_PATTERN.sub('datetime="{last_seen}"', load_fixture("profile.html").replace("{", "{{").replace("}", "}}"), count=1)
+
+def stable_random(key):
+    return random.Random(hashlib.md5(key.encode("utf-8")).digest())
+
+# Админы клуба: 1..max_admins ников из общего пула (одни и те же админы встречаются в разных клубах)
+def club_admins(club_name):
+    rng = stable_random(club_name)
+    count = min(rng.randint(1, state["max_admins"]), state["admin_pool"])
+    return [f"admin{index}" for index in rng.sample(range(state["admin_pool"]), count)]
+
+def club_page(club_name):
+    leaders = ", ".join(
+        f'<a class="user-link ulpt" href="/@/{name}"><i class="line"></i>{name}</a>' for name in club_admins(club_name)
+    )
+    return CLUB_TEMPLATE.format(leaders=leaders)
+
+# Примерно половина админов заходила за последние 60 дней
+def profile_page(admin_name):
+    rng = stable_random(admin_name)
+    days = rng.randint(0, 50) if rng.random() < 0.5 else rng.randint(70, 900)
+    last_seen = datetime.now(timezone.utc) - timedelta(days=days, seconds=rng.randint(0, 86400))
+    return PROFILE_TEMPLATE.format(last_seen=last_seen.strftime("%Y-%m-%dT%H:%M:%S.000Z"))
+
+class FakeLichessHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if state["latency"]:
+            time.sleep(state["latency"])
+        path = self.path.split("?")[0]
+        if path == "/fake/stats":
+            with stats_lock:
+                return self.respond(200, json.dumps(status_counts), "application/json")
+        roll = random.random()
+        if roll < state["throttle_rate"]:
+            return self.respond(429, "Too Many Requests", headers={"Retry-After": str(state["retry_after"])})
+        if roll < state["throttle_rate"] + state["error_rate"]:
+            return self.respond(503, "Service Unavailable")
+        if path.startswith("/team/"):
+            return self.respond(200, club_page(path[len("/team/"):]))
+        if path.startswith("/@/"):
+            return self.respond(200, profile_page(path[len("/@/"):]))
+        self.respond(404, "Not Found")
+
+    def respond(self, status, body, content_type="text/html; charset=utf-8", headers=None):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        with stats_lock:
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    def log_message(self, format, *args):
+        pass
+
+def create_server(host="127.0.0.1", port=0, latency=0.0, error_rate=0.0, throttle_rate=0.0, retry_after=1.0, admin_pool=5000):
+    state.update(latency=latency, error_rate=error_rate, throttle_rate=throttle_rate, retry_after=retry_after, admin_pool=admin_pool)
+    server = ThreadingHTTPServer((host, port), FakeLichessHandler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена lichess.org для замеров парсера")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082, help="порт (0 — любой свободный)")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа в миллисекундах")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After в ответах 429 (секунды)")
+    parser.add_argument("--admin-pool", type=int, default=5000, help="число разных админов на все клубы")
+    args = parser.parse_args()
+    server = create_server(args.host, args.port, args.latency / 1000, args.error_rate, args.throttle_rate, args.retry_after, args.admin_pool)
+    # Первая строка вывода — адрес сервера (по ней замеры находят выбранный порт)
+    print(f"http://{args.host}:{server.server_address[1]}", flush=True)
+    server.serve_forever()
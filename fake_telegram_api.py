@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import ClientSession, web
+
+# Локальная замена Telegram Bot API для проверки бота без сети:
+#   BOT_TOKEN=123456:test TELEGRAM_API_URL=http://127.0.0.1:8081 python bot_chess_copy.py
+# Обновления для бота отправляются POST-запросом на /fake/updates (одно обновление или список);
+# если бот установил вебхук, они пересылаются на него, иначе отдаются через getUpdates.
+# /fake/stats возвращает число вызовов каждого метода и отправленные сообщения.
+
+FAKE_BOT = {"id": 100000, "is_bot": True, "first_name": "Fake", "username": "fake_chess_bot"}
+# Сколько обновлений Telegram одновременно отправляет на вебхук (max_connections по умолчанию)
+WEBHOOK_CONNECTIONS = 40
+
+state = {
+    "webhook_url": None,
+    "latency": 0.0,  # Задержка ответа на каждый вызов метода (в секундах)
+    "flood_every": 0,  # Каждый N-й вызов отправки отвечает 429 Too Many Requests (0 — никогда)
+}
+pending_updates = []  # Обновления для getUpdates
+updates_arrived = asyncio.Event()
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+method_calls = {}  # {метод: число вызовов}
+sent_messages = []  # [(время, chat_id, метод, текст)]
+send_calls = itertools.count(1)
+webhook_semaphore = None
+webhook_session = None
+
+SEND_METHODS = {"sendmessage", "senddocument", "sendmediagroup", "sendphoto", "sendvideo", "editmessagetext"}
+
+# Обновление с текстовым сообщением от пользователя
+def make_message_update(user_id, text, username=None):
+    message = {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User", "username": username or f"user{user_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+# Обновление с нажатием inline-кнопки под сообщением бота
+def make_callback_update(user_id, data, message_id=1):
+    user = {"id": user_id, "is_bot": False, "first_name": "User", "username": f"user{user_id}"}
+    return {"callback_query": {
+        "id": str(next(message_ids)),
+        "from": user,
+        "chat_instance": str(user_id),
+        "data": data,
+        "message": {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": FAKE_BOT,
+            "text": "...",
+        },
+    }}
+
+def make_message(chat_id, text=None):
+    message = {"message_id": next(message_ids), "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}, "from": FAKE_BOT}
+    if text is not None:
+        message["text"] = text
+    return message
+
+# Ответ на вызов метода Bot API
+def call_method(method, params):
+    if method == "getme":
+        return FAKE_BOT
+    if method == "setwebhook":
+        state["webhook_url"] = params.get("url") or None
+        if state["webhook_url"]:
+            asyncio.get_running_loop().create_task(deliver_pending_to_webhook())
+        return True
+    if method == "deletewebhook":
+        state["webhook_url"] = None
+        return True
+    if method == "getwebhookinfo":
+        return {"url": state["webhook_url"] or "", "has_custom_certificate": False, "pending_update_count": len(pending_updates)}
+    if method in ("sendmessage", "editmessagetext"):
+        sent_messages.append((time.time(), params.get("chat_id"), method, params.get("text")))
+        return make_message(params.get("chat_id"), params.get("text"))
+    if method == "sendmediagroup":
+        media = json.loads(params.get("media", "[]"))
+        sent_messages.append((time.time(), params.get("chat_id"), method, f"{len(media)} файлов"))
+        return [make_message(params.get("chat_id")) for _ in media]
+    if method in SEND_METHODS:
+        sent_messages.append((time.time(), params.get("chat_id"), method, params.get("caption")))
+        return make_message(params.get("chat_id"))
+    if method == "getfile":
+        return {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"), "file_path": f"files/{params.get('file_id')}"}
+    return True
+
+async def api_handler(request):
+    method = request.match_info["method"].lower()
+    params = dict(request.query)
+    if request.method == "POST":
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        else:
+            for key, value in (await request.post()).items():
+                params[key] = value if isinstance(value, str) else value.filename
+    method_calls[method] = method_calls.get(method, 0) + 1
+    if state["latency"]:
+        await asyncio.sleep(state["latency"])
+    if method == "getupdates":
+        return web.json_response({"ok": True, "result": await get_updates(params)})
+    if method in SEND_METHODS and state["flood_every"] and next(send_calls) % state["flood_every"] == 0:
+        return web.json_response(
+            {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+            status=429,
+        )
+    return web.json_response({"ok": True, "result": call_method(method, params)})
+
+# Длинный опрос: ждем обновлений до timeout секунд
+async def get_updates(params):
+    offset = int(params.get("offset", 0) or 0)
+    pending_updates[:] = [update for update in pending_updates if update["update_id"] >= offset]
+    if not pending_updates:
+        updates_arrived.clear()
+        try:
+            await asyncio.wait_for(updates_arrived.wait(), timeout=float(params.get("timeout", 0) or 0))
+        except asyncio.TimeoutError:
+            pass
+    limit = int(params.get("limit", 100) or 100)
+    return pending_updates[:limit]
+
+async def post_to_webhook(update):
+    async with webhook_semaphore:
+        try:
+            async with webhook_session.post(state["webhook_url"], json=update) as response:
+                await response.read()
+        except Exception as e:
+            print(f"Не удалось доставить обновление {update['update_id']} на вебхук: {e}")
+
+async def deliver_pending_to_webhook():
+    updates = list(pending_updates)
+    pending_updates.clear()
+    await asyncio.gather(*[post_to_webhook(update) for update in updates])
+
+async def push_updates_handler(request):
+    payload = await request.json()
+    updates = payload if isinstance(payload, list) else [payload]
+    for update in updates:
+        update["update_id"] = next(update_ids)
+    if state["webhook_url"]:
+        # Как и Telegram, ждем ответа вебхука, но отправляем несколько обновлений параллельно
+        await asyncio.gather(*[post_to_webhook(update) for update in updates])
+    else:
+        pending_updates.extend(updates)
+        updates_arrived.set()
+    return web.json_response({"ok": True, "queued": len(updates)})
+
+async def stats_handler(request):
+    return web.json_response({
+        "method_calls": method_calls,
+        "sent_messages": sent_messages,
+        "webhook_url": state["webhook_url"],
+        "pending_updates": len(pending_updates),
+    })
+
+async def file_handler(request):
+    return web.Response(body=f"fake file {request.match_info['path']}".encode())
+
+async def on_startup(app):
+    global webhook_semaphore, webhook_session
+    webhook_semaphore = asyncio.Semaphore(WEBHOOK_CONNECTIONS)
+    webhook_session = ClientSession()
+
+async def on_cleanup(app):
+    await webhook_session.close()
+
+def create_app(latency=0.0, flood_every=0):
+    state["latency"] = latency
+    state["flood_every"] = flood_every
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", api_handler)
+    app.router.add_get("/file/bot{token}/{path:.+}", file_handler)
+    app.router.add_post("/fake/updates", push_updates_handler)
+    app.router.add_get("/fake/stats", stats_handler)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа в миллисекундах")
+    parser.add_argument("--flood-every", type=int, default=0, help="отвечать 429 на каждый N-й вызов отправки")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency / 1000, args.flood_every), host=args.host, port=args.port)
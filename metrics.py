@@ -0,0 +1,140 @@
+import bisect
+import contextlib
+import math
+import os
+import threading
+import time
+
+# Простые метрики в текстовом формате Prometheus: счетчики, значения (gauge) и гистограммы.
+# Используются ботом (эндпоинт /metrics и команда /metrics) и парсером (файл метрик).
+# Все функции потокобезопасны: парсер и пул потоков бота пишут метрики из разных потоков
+
+# Границы корзин гистограмм длительностей (в секундах)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+metrics_lock = threading.Lock()
+metric_help = {}  # {имя: (тип, описание)}
+counters = {}  # {(имя, метки): значение}
+gauges = {}  # {(имя, метки): значение}
+histograms = {}  # {(имя, метки): {"buckets": [...], "counts": [...], "sum": ..., "count": ...}}
+
+def describe(name, metric_type, help_text):
+    metric_help[name] = (metric_type, help_text)
+
+def label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def inc(name, value=1, **labels):
+    key = (name, label_key(labels))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+def set_gauge(name, value, **labels):
+    with metrics_lock:
+        gauges[(name, label_key(labels))] = value
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    key = (name, label_key(labels))
+    with metrics_lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "sum": 0.0, "count": 0}
+        histogram["counts"][bisect.bisect_left(histogram["buckets"], value)] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+# Замер длительности блока кода: with metrics.timed("name", label=...): ...
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in pairs) + "}"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Все метрики в текстовом формате Prometheus
+def render():
+    with metrics_lock:
+        counter_items = sorted(counters.items())
+        gauge_items = sorted(gauges.items())
+        histogram_items = sorted((key, dict(value, counts=list(value["counts"]))) for key, value in histograms.items())
+    lines = []
+    described = set()
+
+    def header(name, default_type):
+        if name not in described:
+            described.add(name)
+            metric_type, help_text = metric_help.get(name, (default_type, ""))
+            if help_text:
+                lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in counter_items:
+        header(name, "counter")
+        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for (name, labels), value in gauge_items:
+        header(name, "gauge")
+        lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for (name, labels), histogram in histogram_items:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(list(histogram["buckets"]) + [math.inf], histogram["counts"]):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(labels, [('le', format_value(bound))])} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {format_value(histogram['sum'])}")
+        lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+# Оценка квантиля по корзинам гистограммы (верхняя граница корзины, как без интерполяции)
+def histogram_quantile(histogram, quantile):
+    rank = quantile * histogram["count"]
+    cumulative = 0
+    for bound, bucket_count in zip(list(histogram["buckets"]) + [math.inf], histogram["counts"]):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return math.inf
+
+# Сводка гистограмм для человека: {метки: (число, среднее, p50, p95)}
+def histogram_summary(name):
+    with metrics_lock:
+        items = [(labels, dict(value, counts=list(value["counts"]))) for (metric, labels), value in histograms.items() if metric == name]
+    return {
+        labels: (
+            histogram["count"],
+            histogram["sum"] / histogram["count"] if histogram["count"] else 0.0,
+            histogram_quantile(histogram, 0.5),
+            histogram_quantile(histogram, 0.95),
+        )
+        for labels, histogram in items
+    }
+
+# Значения счетчика по меткам: {метки: значение}
+def counter_values(name):
+    with metrics_lock:
+        return {labels: value for (metric, labels), value in counters.items() if metric == name}
+
+def gauge_value(name, default=None, **labels):
+    with metrics_lock:
+        return gauges.get((name, label_key(labels)), default)
+
+# Запись метрик в файл (для пакетных задач вроде парсера: файл читает textfile-коллектор)
+def write_metrics_file(filename):
+    tmp_file = filename + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_file, filename)
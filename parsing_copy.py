@@ -1,7 +1,25 @@
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import random
+import re
+import socket
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
-from openpyxl import Workbook
-from datetime import datetime, timedelta
+from openpyxl import Workbook, load_workbook
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from html.parser import HTMLParser
+import metrics
 
 # Заголовки для избегания блокировок
 headers = {
@@ -9,105 +27,904 @@ headers = {
     "User-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36"
 }
 
-# Функция для проверки времени последнего визита
-def check_last_online(admin_url):
+# Адрес сайта для ссылок на профили администраторов (для замеров — адрес локальной копии fake_lichess.py)
+LICHESS_URL = os.environ.get("LICHESS_URL", "https://lichess.org")
+
+# Количество потоков обхода клубов (1 — последовательный режим)
+MAX_WORKERS = 8
+# Максимум одновременных запросов к одному хосту
+PER_HOST_LIMIT = 4
+
+# Колонка AF с суммой активных админов и число админов, помещающихся до нее
+AF_COLUMN_INDEX = 32
+ADMINS_BEFORE_AF = 10
+
+# Компактная копия таблицы для бота: club_url, admin_count, active_count (целые),
+# last_seen — ISO-время визита каждого админа через ";" (пусто, если неизвестно)
+CLUBS_CSV_FILE = "lichess_club_admins.csv"
+CLUBS_CSV_COLUMNS = ["club_url", "admin_count", "active_count", "last_seen"]
+
+# Способ разбора страниц: "fast" — только нужный блок без построения дерева, "bs4" — BeautifulSoup
+EXTRACTOR = "fast"
+
+# Журнал обработанных клубов для продолжения обхода после сбоя
+CRAWL_JOURNAL_FILE = "crawl_journal.jsonl"
+
+# Распределенный обход. В режиме --shard i/n процесс обходит только свою часть клубов
+# и пишет журнал части в PARTIALS_DIR; в режиме очереди (--queue) процессы на разных машинах
+# забирают пачки клубов из общей папки. Шаг --merge собирает части в одну таблицу и, если
+# обработаны все клубы, удаляет журналы частей, чтобы следующий обход начался заново
+PARTIALS_DIR = "crawl_partials"
+QUEUE_SUBDIRS = ("pending", "claimed", "done", "partials")
+# Сколько клубов в одной пачке очереди
+QUEUE_CHUNK_SIZE = 500
+# Пачка, которую обработчик не обновлял столько секунд, считается брошенной и забирается заново
+QUEUE_CLAIM_TIMEOUT = 30 * 60
+
+# Кэш активности администраторов между клубами и запусками
+ADMIN_CACHE_FILE = "admin_activity_cache.json"
+# Через сколько секунд запись кэша считается устаревшей (0 — кэш не используется)
+ADMIN_CACHE_TTL = 24 * 60 * 60
+admin_cache = {}  # {admin_url: {"last_seen": datetime-строка или None, "checked_at": unix-время}}
+admin_cache_lock = threading.Lock()
+admin_url_locks = {}  # {admin_url: Lock}
+
+# Общая сессия с keep-alive соединениями для всех потоков
+session = requests.Session()
+session.headers.update(headers)
+
+# Пул соединений должен вмещать все потоки, иначе keep-alive соединения будут закрываться
+def mount_adapters(pool_size):
+    for prefix in ("https://", "http://"):
+        session.mount(prefix, HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+
+mount_adapters(MAX_WORKERS)
+
+# Семафоры для ограничения параллельных запросов к каждому хосту: {host: Semaphore}
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+
+# Настройка количества потоков и лимита запросов на хост
+def configure_concurrency(workers, per_host):
+    global MAX_WORKERS, PER_HOST_LIMIT
+    MAX_WORKERS = max(1, workers)
+    PER_HOST_LIMIT = max(1, per_host)
+    with host_semaphores_lock:
+        host_semaphores.clear()
+    mount_adapters(MAX_WORKERS)
+
+# Семафор хоста, создается при первом обращении
+def get_host_semaphore(url):
+    host = urlsplit(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+        return host_semaphores[host]
+
+# Параметры адаптивного ограничения скорости (запросов в секунду)
+RATE_LIMIT = 4.0
+RATE_LIMIT_MIN = 0.5
+RATE_LIMIT_MAX = 8.0
+# Прирост скорости после каждого успешного ответа
+RATE_LIMIT_STEP = 0.1
+# Повторы при 429/5xx и сетевых ошибках с экспоненциальной задержкой
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+REQUEST_TIMEOUT = 30
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Некорректная ссылка (нет схемы, опечатка) считается ответом 400 Bad Request: повтор не поможет
+INVALID_URL_ERRORS = (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema, requests.exceptions.InvalidURL)
+
+# Окончательные ответы: ошибки клиента 4xx (страница не существует, закрыта, ссылка неверна),
+# кроме 429 — повторять бессмысленно
+def is_definitive_status(status):
+    return status is not None and 400 <= status < 500 and status != 429
+
+# Папка для ETag/Last-Modified страниц (условные запросы) вместе с тем, что из страницы
+# извлечено (ссылки админов или время визита): сами страницы занимают по 130-160 КБ
+HTTP_CACHE_DIR = "http_cache"
+
+# Метрики обхода в текстовом формате Prometheus (перезаписываются в конце каждого запуска)
+CRAWLER_METRICS_FILE = "crawler_metrics.prom"
+metrics.describe("crawler_fetch_seconds", "histogram", "Длительность HTTP-запроса к lichess.org")
+metrics.describe("crawler_requests_total", "counter", "HTTP-запросы по статусу ответа")
+metrics.describe("crawler_rate_limit", "gauge", "Текущий лимит запросов в секунду")
+metrics.describe("crawler_clubs_total", "gauge", "Клубы последнего обхода по результату")
+
+# Состояние token bucket, общее для всех потоков
+rate_state = {"rate": RATE_LIMIT, "tokens": 1.0, "updated": time.monotonic(), "paused_until": 0.0}
+rate_lock = threading.Lock()
+
+# Счетчики текущего запуска
+fetch_stats = {"requests": 0, "bytes": 0, "not_modified": 0, "throttled": 0, "retries": 0, "errors": 0}
+fetch_stats_lock = threading.Lock()
+
+def count(name, value=1):
+    with fetch_stats_lock:
+        fetch_stats[name] += value
+
+# Ожидание свободного токена; после 429 все потоки ждут окончания паузы
+def acquire_token():
+    while True:
+        with rate_lock:
+            now = time.monotonic()
+            if now < rate_state["paused_until"]:
+                wait = rate_state["paused_until"] - now
+            else:
+                elapsed = now - rate_state["updated"]
+                # Емкость не меньше одного токена, иначе при скорости < 1 запр./с токен не накопится
+                capacity = max(1.0, rate_state["rate"])
+                rate_state["tokens"] = min(capacity, rate_state["tokens"] + elapsed * rate_state["rate"])
+                rate_state["updated"] = now
+                if rate_state["tokens"] >= 1:
+                    rate_state["tokens"] -= 1
+                    return
+                wait = (1 - rate_state["tokens"]) / rate_state["rate"]
+        time.sleep(wait)
+
+# Сервер просит притормозить: вдвое снижаем скорость и приостанавливаем все запросы
+def on_throttled(retry_after):
+    with rate_lock:
+        now = time.monotonic()
+        # Ответы 429 на запросы, отправленные до паузы, не должны снижать скорость повторно
+        if now >= rate_state["paused_until"]:
+            rate_state["rate"] = max(RATE_LIMIT_MIN, rate_state["rate"] / 2)
+        rate_state["tokens"] = 0.0
+        rate_state["paused_until"] = max(rate_state["paused_until"], now + retry_after)
+
+def on_success():
+    with rate_lock:
+        rate_state["rate"] = min(RATE_LIMIT_MAX, rate_state["rate"] + RATE_LIMIT_STEP)
+
+# Значение Retry-After может быть числом секунд или HTTP-датой
+def parse_retry_after(value):
+    if not value:
+        return None
     try:
-        response = requests.get(admin_url, headers=headers)
-        if response.status_code != 200:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt):
+    # Full jitter: случайная задержка от нуля до экспоненциального предела
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def http_cache_path(url):
+    return os.path.join(HTTP_CACHE_DIR, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+# Записи прежнего формата (с телом страницы, без "result") не используются
+def load_http_cache(url):
+    try:
+        with open(http_cache_path(url), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if isinstance(entry, dict) and "result" in entry else None
+
+def save_http_cache(url, response, result):
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if not etag and not last_modified:
+        return
+    os.makedirs(HTTP_CACHE_DIR, exist_ok=True)
+    path = http_cache_path(url)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"etag": etag, "last_modified": last_modified, "result": result}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+# GET-запрос через общую сессию: лимит на хост, token bucket, повторы и условные запросы.
+# Страница сразу разбирается функцией extract, и в кэше хранится только ее результат.
+# Возвращает (код ответа, результат extract или None); код None — сеть недоступна после всех повторов
+def fetch(url, extract):
+    cached = load_http_cache(url)
+    request_headers = {}
+    if cached:
+        if cached.get("etag"):
+            request_headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            request_headers["If-Modified-Since"] = cached["last_modified"]
+    status = None
+    for attempt in range(MAX_RETRIES + 1):
+        if attempt:
+            count("retries")
+        acquire_token()
+        start = time.perf_counter()
+        try:
+            with get_host_semaphore(url):
+                response = session.get(url, headers=request_headers, timeout=REQUEST_TIMEOUT)
+        except INVALID_URL_ERRORS as e:
+            metrics.inc("crawler_requests_total", status="invalid_url")
+            count("errors")
+            print(f"Некорректная ссылка {url}: {e}")
+            return 400, None
+        except requests.RequestException as e:
+            metrics.observe("crawler_fetch_seconds", time.perf_counter() - start, status="error")
+            metrics.inc("crawler_requests_total", status="error")
+            count("errors")
+            print(f"Сетевая ошибка для {url}: {e}")
+            status = None
+            time.sleep(backoff_delay(attempt))
+            continue
+        count("requests")
+        count("bytes", len(response.content))
+        status = response.status_code
+        metrics.observe("crawler_fetch_seconds", time.perf_counter() - start, status=status)
+        metrics.inc("crawler_requests_total", status=status)
+        if status == 304 and cached:
+            count("not_modified")
+            on_success()
+            return 200, cached["result"]
+        if status == 429:
+            count("throttled")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            on_throttled(retry_after if retry_after is not None else backoff_delay(attempt))
+            continue
+        if status in RETRY_STATUSES:
+            count("errors")
+            time.sleep(backoff_delay(attempt))
+            continue
+        if status == 200:
+            on_success()
+            result = extract(response.text)
+            save_http_cache(url, response, result)
+            return status, result
+        return status, None
+    return status, None
+
+# Вывод счетчиков запросов за запуск
+def print_fetch_stats():
+    with fetch_stats_lock:
+        stats = dict(fetch_stats)
+    print(
+        f"Запросов: {stats['requests']}, получено {stats['bytes'] / 1024 / 1024:.1f} МБ, "
+        f"не изменилось (304): {stats['not_modified']}, ограничений (429): {stats['throttled']}, "
+        f"повторов: {stats['retries']}, ошибок: {stats['errors']}, "
+        f"итоговая скорость: {rate_state['rate']:.2f} запр./с"
+    )
+
+# Быстрый разбор: регулярным выражением находим открывающий тег нужного блока и
+# токенизируем только его, останавливаясь на закрывающем теге
+class StopExtraction(Exception):
+    pass
+
+class BlockParser(HTMLParser):
+    def __init__(self, block_tag, collect_tag, collect_attr, first_only):
+        super().__init__(convert_charrefs=True)
+        self.block_tag = block_tag
+        self.collect_tag = collect_tag
+        self.collect_attr = collect_attr
+        self.first_only = first_only
+        self.depth = 0
+        self.values = []  # значения атрибута; None — тег найден, но атрибута нет
+        self.closed = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == self.block_tag:
+            self.depth += 1
+        elif tag == self.collect_tag:
+            self.collect(attrs)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == self.collect_tag:
+            self.collect(attrs)
+
+    def handle_endtag(self, tag):
+        if tag == self.block_tag:
+            self.depth -= 1
+            if self.depth == 0:
+                self.closed = True
+                raise StopExtraction
+
+    def collect(self, attrs):
+        self.values.append(dict(attrs).get(self.collect_attr))
+        if self.first_only:
+            raise StopExtraction
+
+# Открывающий тег с нужным классом (класс может стоять среди других)
+def block_start_pattern(tag, class_name):
+    return re.compile(
+        rf"<{tag}\b[^>]*?\bclass\s*=\s*[\"'](?:[^\"']*\s)?{re.escape(class_name)}(?:\s[^\"']*)?[\"']",
+        re.IGNORECASE,
+    )
+
+ADMIN_SECTION_START = block_start_pattern("section", "team-show__meta")
+STATS_DIV_START = block_start_pattern("div", "stats")
+
+def parse_block(html, start_pattern, block_tag, collect_tag, collect_attr, first_only=False):
+    match = start_pattern.search(html)
+    if not match:
+        return None
+    parser = BlockParser(block_tag, collect_tag, collect_attr, first_only)
+    try:
+        parser.feed(html[match.start():])
+    except StopExtraction:
+        pass
+    return parser.values
+
+# Ссылки из секции администраторов клуба; None — секция не найдена
+def extract_admin_hrefs_fast(html):
+    values = parse_block(html, ADMIN_SECTION_START, "section", "a", "href")
+    if values is None:
+        return None
+    return [href for href in values if href is not None]
+
+def extract_admin_hrefs_bs4(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    admin_section = soup.find('section', class_='team-show__meta')
+    if not admin_section:
+        return None
+    return [a['href'] for a in admin_section.find_all('a', href=True)]
+
+# Время последнего визита: (блок stats найден, datetime-строка или None)
+def extract_last_seen_fast(html):
+    values = parse_block(html, STATS_DIV_START, "div", "time", "datetime", first_only=True)
+    if values is None:
+        return False, None
+    return True, values[0] if values else None
+
+def extract_last_seen_bs4(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    stats_div = soup.find('div', class_='stats')
+    if not stats_div:
+        return False, None
+    time_tag = stats_div.find('time')
+    if time_tag and 'datetime' in time_tag.attrs:
+        return True, time_tag['datetime']
+    return True, None
+
+# Если быстрый разбор не нашел блок (например, нестандартная разметка), повторяем через BeautifulSoup
+def extract_admin_hrefs(html):
+    if EXTRACTOR == "fast":
+        hrefs = extract_admin_hrefs_fast(html)
+        if hrefs is not None:
+            return hrefs
+    return extract_admin_hrefs_bs4(html)
+
+def extract_last_seen(html):
+    if EXTRACTOR == "fast":
+        found, last_seen = extract_last_seen_fast(html)
+        if found:
+            return found, last_seen
+    return extract_last_seen_bs4(html)
+
+# Загрузка профиля и поиск времени последнего визита.
+# Возвращает (успех, datetime-строка или None); неуспешные ответы не кэшируются
+def fetch_last_seen(admin_url):
+    try:
+        status, extracted = fetch(admin_url, extract_last_seen)
+        if is_definitive_status(status):
+            # Профиль удален или закрыт — это окончательный ответ, а не сбой
+            print(f"Профиль недоступен ({status}) для {admin_url}")
+            return True, None
+        if status != 200:
             print(f"Не удалось получить данные для {admin_url}")
-            return 0
-        soup = BeautifulSoup(response.text, 'html.parser')
-        stats_div = soup.find('div', class_='stats')
-        if not stats_div:
+            return False, None
+        found, last_seen = extracted
+        if not found:
             print(f"Не удалось найти блок с информацией для {admin_url}")
-            return 0
-        time_tag = stats_div.find('time')
-        if time_tag and 'datetime' in time_tag.attrs:
-            last_online_str = time_tag['datetime']
-            try:
-                last_online_time = datetime.fromisoformat(last_online_str.rstrip('Z'))
-            except ValueError as e:
-                print(f"Ошибка преобразования даты для {admin_url}: {e}")
-                return 0
-            now = datetime.now()
-            time_difference = now - last_online_time
-            if time_difference <= timedelta(days=60):
-                return 1
-            else:
-                return 0
-        else:
-            print(f"Не удалось найти тэг <time> или атрибут 'datetime' для {admin_url}")
-            return 0
+            return True, None
+        if last_seen:
+            return True, last_seen
+        print(f"Не удалось найти тэг <time> или атрибут 'datetime' для {admin_url}")
+        return True, None
     except Exception as e:
         print(f"Ошибка при проверке активности администратора {admin_url}: {e}")
+        return False, None
+
+# Загрузка кэша активности администраторов
+def load_admin_cache():
+    if not os.path.exists(ADMIN_CACHE_FILE):
+        return
+    try:
+        with open(ADMIN_CACHE_FILE, "r", encoding="utf-8") as f:
+            admin_cache.update(json.load(f))
+    except (OSError, ValueError) as e:
+        print(f"Не удалось загрузить кэш администраторов: {e}")
+
+# Сохранение кэша через временный файл, чтобы не повредить его при сбое. Кэш может быть
+# общим для нескольких процессов обхода, поэтому записи с диска, которые новее наших, сохраняются
+def save_admin_cache():
+    with admin_cache_lock:
+        snapshot = dict(admin_cache)
+    try:
+        with open(ADMIN_CACHE_FILE, "r", encoding="utf-8") as f:
+            on_disk = json.load(f)
+    except (OSError, ValueError):
+        on_disk = {}
+    for admin_url, entry in on_disk.items():
+        if admin_url not in snapshot or entry["checked_at"] > snapshot[admin_url]["checked_at"]:
+            snapshot[admin_url] = entry
+    tmp_file = f"{ADMIN_CACHE_FILE}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_file, ADMIN_CACHE_FILE)
+
+# Время последнего визита с учетом кэша: профиль загружается только для устаревших записей.
+# Возвращает (успех, datetime-строка или None)
+def get_last_seen(admin_url):
+    with admin_cache_lock:
+        url_lock = admin_url_locks.setdefault(admin_url, threading.Lock())
+    # Один и тот же админ может встретиться в нескольких клубах одновременно — грузим его один раз
+    with url_lock:
+        entry = admin_cache.get(admin_url)
+        if entry and time.time() - entry["checked_at"] < ADMIN_CACHE_TTL:
+            return True, entry["last_seen"]
+        ok, last_seen = fetch_last_seen(admin_url)
+        if ok:
+            with admin_cache_lock:
+                admin_cache[admin_url] = {"last_seen": last_seen, "checked_at": time.time()}
+        return ok, last_seen
+
+# Статус активности по времени последнего визита: 1 — заходил за последние 60 дней
+def activity_status(admin_url, last_online_str):
+    if not last_online_str:
+        return 0
+    try:
+        last_online_time = datetime.fromisoformat(last_online_str.rstrip('Z'))
+    except ValueError as e:
+        print(f"Ошибка преобразования даты для {admin_url}: {e}")
+        return 0
+    now = datetime.now()
+    time_difference = now - last_online_time
+    if time_difference <= timedelta(days=60):
+        return 1
+    else:
         return 0
 
-# Функция для получения списка администраторов клуба
+# Функция для проверки времени последнего визита
+def check_last_online(admin_url):
+    _, last_seen = get_last_seen(admin_url)
+    return activity_status(admin_url, last_seen)
+
+# Функция для получения списка администраторов клуба.
+# Возвращает None, если страницу не удалось загрузить, — такой клуб не попадет в журнал
 def get_club_admins(club_url):
     try:
-        response = requests.get(club_url, headers=headers)
-        if response.status_code != 200:
-            print(f"Не удалось получить данные для {club_url}")
+        status, hrefs = fetch(club_url, extract_admin_hrefs)
+        if is_definitive_status(status):
+            print(f"Клуб не существует или недоступен ({status}): {club_url}")
             return []
-        soup = BeautifulSoup(response.text, 'html.parser')
-        admin_section = soup.find('section', class_='team-show__meta')
-        if not admin_section:
+        if status != 200:
+            print(f"Не удалось получить данные для {club_url}")
+            return None
+        if hrefs is None:
             print(f"Не удалось найти секцию администраторов для {club_url}")
             return []
-        admin_links = admin_section.find_all('a', href=True)
         admins = []
-        for a in admin_links:
-            href = a['href']
+        for href in hrefs:
             if href.startswith('/@/'):
-                admin_url = 'https://lichess.org' + href
+                admin_url = LICHESS_URL + href
                 admin_name = href.split('/@/')[1]
                 admins.append((admin_url, admin_name))
         return admins
     except Exception as e:
         print(f"Ошибка при получении администраторов для {club_url}: {e}")
-        return []
+        return None
 
-# Основная функция для сбора данных
-def collect_data():
-    try:
-        with open('clubs_domens.txt', 'r') as f:
-            club_links = [line.strip() for line in f.readlines()]
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Клубы и админы"
-        ws.append(["Клуб URL", "Админ URL 1", "Имя админа 1", "Статус 1", 
-                   "Админ URL 2", "Имя админа 2", "Статус 2", 
-                   "Админ URL 3", "Имя админа 3", "Статус 3"])
+# Обработка одного клуба: возвращает запись журнала или None, если клуб не удалось загрузить
+def process_club(club_url):
+    print(f"Обработка {club_url}...")
+    admins = get_club_admins(club_url)
+    if admins is None:
+        return None
+    if not admins:
+        print(f"Админы не найдены для {club_url}")
+    entry = {"club": club_url, "admins": []}
+    for admin_url, admin_name in admins:
+        ok, last_seen = get_last_seen(admin_url)
+        if not ok:
+            # Без ответа сервера нельзя считать админа неактивным — клуб останется в очереди
+            print(f"Не удалось проверить {admin_url}, клуб {club_url} будет обработан повторно")
+            return None
+        entry["admins"].append([admin_url, admin_name, activity_status(admin_url, last_seen), last_seen])
+    return entry
+
+# Чтение журнала обработанных клубов: {club_url: [[admin_url, admin_name, status, last_seen], ...]}
+def load_journal(journal_file=CRAWL_JOURNAL_FILE):
+    done = {}
+    if not os.path.exists(journal_file):
+        return done
+    with open(journal_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Последняя строка могла оборваться при сбое — клуб будет обработан заново
+                continue
+            done[entry["club"]] = entry["admins"]
+    return done
+
+# Расположение строки: первые десять админов в колонках B..AE, сумма активных в AF,
+# остальные админы — после AF, чтобы колонка AF всегда оставалась на месте
+def layout_row(club_url, admins):
+    row_data = [club_url]
+    for admin_url, admin_name, status, _ in admins[:ADMINS_BEFORE_AF]:
+        row_data.extend([admin_url, admin_name, status])
+    row_data.extend([None] * (AF_COLUMN_INDEX - 1 - len(row_data)))
+    row_data.append(sum(status for _, _, status, _ in admins))
+    for admin_url, admin_name, status, _ in admins[ADMINS_BEFORE_AF:]:
+        row_data.extend([admin_url, admin_name, status])
+    return row_data
+
+# Сборка таблицы из журнала в порядке списка клубов. Книга пишется потоково (write_only),
+# сумма активных админов считается в том же проходе. Рядом пишется компактный CSV
+# с типизированными колонками, который бот читает быстрее XLSX
+def build_workbook(club_links, done, filename="lichess_club_admins.xlsx", csv_filename=CLUBS_CSV_FILE):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Клубы и админы")
+    header = ["Клуб URL", "Админ URL 1", "Имя админа 1", "Статус 1", 
+              "Админ URL 2", "Имя админа 2", "Статус 2", 
+              "Админ URL 3", "Имя админа 3", "Статус 3"]
+    header.extend([None] * (AF_COLUMN_INDEX - 1 - len(header)))
+    header.append("Активных админов")
+    ws.append(header)
+    tmp_csv = csv_filename + ".tmp"
+    with open(tmp_csv, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(CLUBS_CSV_COLUMNS)
         for club_url in club_links:
-            print(f"Обработка {club_url}...")
-            admins = get_club_admins(club_url)
+            admins = done.get(club_url)
             if not admins:
-                print(f"Админы не найдены для {club_url}")
                 continue
-            row_data = [club_url]
-            for admin_url, admin_name in admins:
-                activity_status = check_last_online(admin_url)
-                row_data.extend([admin_url, admin_name, activity_status])
+            row_data = layout_row(club_url, admins)
             ws.append(row_data)
-        wb.save("lichess_club_admins.xlsx")
+            last_seen = ";".join(admin[3] or "" for admin in admins)
+            writer.writerow([club_url, len(admins), row_data[AF_COLUMN_INDEX - 1], last_seen])
+    wb.save(filename)
+    # CSV заменяется после XLSX, поэтому он не старше таблицы и бот может ему доверять
+    os.replace(tmp_csv, csv_filename)
+
+# Пустые строки пропускаются: иначе такой "клуб" никогда не обработается и журнал не будет удален
+def read_club_links(filename="clubs_domens.txt"):
+    with open(filename, 'r') as f:
+        return [line.strip() for line in f.readlines() if line.strip()]
+
+# Клуб попадает в часть по контрольной сумме ссылки: разбиение не зависит от порядка
+# строк в файле и одинаково на всех машинах
+def in_shard(club_url, shard):
+    index, count = shard
+    return zlib.crc32(club_url.encode("utf-8")) % count == index - 1
+
+# Журнал части привязан к списку клубов: в имени контрольная сумма clubs_domens.txt,
+# поэтому журналы обхода другого списка не продолжаются и не попадают в --merge
+def club_list_digest(club_links):
+    return hashlib.sha1("\n".join(club_links).encode("utf-8")).hexdigest()[:12]
+
+def shard_journal_file(shard, digest, partials_dir=None):
+    index, count = shard
+    return os.path.join(partials_dir or PARTIALS_DIR, f"shard-{index}-of-{count}-{digest}.jsonl")
+
+# Обход клубов с записью в журнал; done дополняется обработанными клубами.
+# У heartbeat_file (взятой пачки очереди) каждая запись обновляет время изменения
+def crawl_clubs(pending, done, journal_file, workers, heartbeat_file=None):
+    # Журнал пишется только из основного потока, каждая запись сразу сбрасывается на диск
+    with open(journal_file, "a", encoding="utf-8") as journal:
+        def record(entry):
+            if entry is None:
+                return
+            journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            journal.flush()
+            done[entry["club"]] = entry["admins"]
+            if heartbeat_file:
+                try:
+                    os.utime(heartbeat_file)
+                except OSError:
+                    pass
+
+        if workers > 1:
+            pool = ThreadPoolExecutor(max_workers=workers)
+            futures = [pool.submit(process_club, club_url) for club_url in pending]
+            recorded = set()
+            try:
+                for future in as_completed(futures):
+                    record(future.result())
+                    recorded.add(future)
+            except BaseException:
+                # При прерывании (Ctrl-C) или ошибке клубы, которые еще не начаты, отменяются.
+                # Уже начатые дожидаемся (интерпретатор все равно ждет потоки при выходе)
+                # и записываем в журнал, чтобы повторный запуск их не загружал
+                pool.shutdown(wait=False, cancel_futures=True)
+                print("Обход прерван, дожидаемся клубов, которые уже обрабатываются...")
+                for future in futures:
+                    if future not in recorded and not future.cancelled() and future.exception() is None:
+                        record(future.result())
+                raise
+            finally:
+                pool.shutdown()
+        else:
+            for club_url in pending:
+                record(process_club(club_url))
+
+def reset_fetch_stats():
+    with fetch_stats_lock:
+        for name in fetch_stats:
+            fetch_stats[name] = 0
+
+# Итоги запуска: счетчики запросов, файл метрик и кэш админов (пишутся даже при сбое)
+def finish_run(metrics_file=CRAWLER_METRICS_FILE):
+    print_fetch_stats()
+    metrics.set_gauge("crawler_rate_limit", rate_state["rate"])
+    try:
+        metrics.write_metrics_file(metrics_file)
+    except OSError as e:
+        print(f"Не удалось записать метрики: {e}")
+    # Кэш сохраняем даже при сбое, чтобы повторный запуск не загружал профили заново
+    try:
+        save_admin_cache()
+    except OSError as e:
+        print(f"Не удалось сохранить кэш администраторов: {e}")
+
+# Основная функция для сбора данных. С shard=(i, n) обходится только i-я из n частей списка:
+# ее журнал остается в PARTIALS_DIR, а таблицу собирает merge_partials после всех частей
+def collect_data(workers=None, journal_file=CRAWL_JOURNAL_FILE, shard=None):
+    workers = workers or MAX_WORKERS
+    reset_fetch_stats()
+    load_admin_cache()
+    metrics_file = CRAWLER_METRICS_FILE
+    try:
+        club_links = read_club_links()
+        crawl_links = club_links
+        if shard:
+            journal_file = shard_journal_file(shard, club_list_digest(club_links))
+            os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+            metrics_file = CRAWLER_METRICS_FILE.replace(".prom", f".shard-{shard[0]}-of-{shard[1]}.prom")
+            crawl_links = [club_url for club_url in club_links if in_shard(club_url, shard)]
+        done = load_journal(journal_file)
+        pending = [club_url for club_url in dict.fromkeys(crawl_links) if club_url not in done]
+        if done:
+            print(f"Продолжаем обход: уже обработано {len(done)} клубов, осталось {len(pending)}")
+        crawl_clubs(pending, done, journal_file, workers)
+        failed = sum(1 for club_url in dict.fromkeys(crawl_links) if club_url not in done)
+        metrics.set_gauge("crawler_clubs_total", len(done), result="done")
+        metrics.set_gauge("crawler_clubs_total", failed, result="failed")
+        if shard:
+            print(f"Часть {shard[0]} из {shard[1]} сохранена в '{journal_file}'. Когда все части готовы, запустите --merge")
+            if failed:
+                print(f"Не удалось обработать {failed} клубов. Запустите эту часть повторно, чтобы догрузить их.")
+            return
+        # Строки собираются в порядке списка клубов, поэтому результат не зависит от числа потоков
+        build_workbook(club_links, done)
         print("Данные сохранены в 'lichess_club_admins.xlsx'")
+        if failed:
+            print(f"Не удалось обработать {failed} клубов. Запустите скрипт повторно, чтобы догрузить их.")
+        else:
+            os.remove(journal_file)
     except Exception as e:
         print(f"Произошла ошибка: {e}")
+    finally:
+        finish_run(metrics_file)
+
+# Очередь в общей папке: pending/ — пачки клубов, claimed/ — взятые в работу (к имени
+# добавляется обработчик), done/ — готовые, partials/ — журналы пачек. Пачка берется
+# переименованием файла, поэтому ее получает ровно один процесс даже на разных машинах.
+# Папка с файлами прежнего обхода не переиспользуется: его готовые пачки и журналы засчитали бы
+# новые пачки как обработанные. С fresh=True эти файлы удаляются
+def init_queue(queue_dir, chunk_size=QUEUE_CHUNK_SIZE, fresh=False):
+    club_links = list(dict.fromkeys(read_club_links()))
+    leftovers = queue_files(queue_dir)
+    if leftovers and not fresh:
+        print(
+            f"Очередь '{queue_dir}' уже содержит {len(leftovers)} файлов прежнего обхода. Завершите его (--merge) "
+            f"или начните заново с --fresh"
+        )
+        return
+    for path in leftovers:
+        os.remove(path)
+    for name in QUEUE_SUBDIRS:
+        os.makedirs(os.path.join(queue_dir, name), exist_ok=True)
+    for number, start in enumerate(range(0, len(club_links), chunk_size)):
+        chunk_file = os.path.join(queue_dir, "pending", f"chunk-{number:05d}.txt")
+        with open(chunk_file + ".tmp", "w") as f:
+            f.write("\n".join(club_links[start:start + chunk_size]) + "\n")
+        os.replace(chunk_file + ".tmp", chunk_file)
+    print(f"Очередь '{queue_dir}': {len(club_links)} клубов в {-(-len(club_links) // chunk_size)} пачках")
+
+def queue_files(queue_dir):
+    return [
+        os.path.join(queue_dir, name, file_name)
+        for name in QUEUE_SUBDIRS if os.path.isdir(os.path.join(queue_dir, name))
+        for file_name in os.listdir(os.path.join(queue_dir, name))
+    ]
+
+def queue_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+# Взять свободную пачку или брошенную (обработчик не обновлял ее дольше QUEUE_CLAIM_TIMEOUT).
+# Пачки из skip (уже возвращенные этим обработчиком) не берутся.
+# Возвращает (имя пачки, путь к взятому файлу) или None, если работы не осталось
+def claim_chunk(queue_dir, skip=()):
+    worker = queue_worker_id()
+    claimed_dir = os.path.join(queue_dir, "claimed")
+    candidates = [(os.path.join(queue_dir, "pending", name), name) for name in sorted(os.listdir(os.path.join(queue_dir, "pending")))]
+    for name in sorted(os.listdir(claimed_dir)):
+        path = os.path.join(claimed_dir, name)
+        try:
+            if time.time() - os.path.getmtime(path) > QUEUE_CLAIM_TIMEOUT:
+                candidates.append((path, name.split("@")[0]))
+        except OSError:
+            continue
+    for path, chunk in candidates:
+        if not chunk.endswith(".txt") or chunk in skip:
+            continue
+        claimed_path = os.path.join(claimed_dir, f"{chunk}@{worker}")
+        try:
+            os.rename(path, claimed_path)
+        except OSError:
+            # Пачку уже забрал другой процесс
+            continue
+        os.utime(claimed_path)
+        return chunk, claimed_path
+    return None
+
+# Обработчик очереди: берет пачки, пока они есть. Недообработанная пачка возвращается
+# в pending/, ее журнал сохраняется, и следующий обработчик продолжит с места остановки.
+# Возвращенную пачку этот обработчик больше не берет, чтобы не обходить без конца
+# клубы, которые не загружаются
+def crawl_queue(queue_dir, workers=None):
+    workers = workers or MAX_WORKERS
+    reset_fetch_stats()
+    load_admin_cache()
+    chunks = 0
+    returned = {}  # {пачка: число необработанных клубов}
+    try:
+        while True:
+            claimed = claim_chunk(queue_dir, skip=returned)
+            if claimed is None:
+                break
+            chunk, claimed_path = claimed
+            chunks += 1
+            journal_file = os.path.join(queue_dir, "partials", chunk.replace(".txt", ".jsonl"))
+            crawl_links = read_club_links(claimed_path)
+            done = load_journal(journal_file)
+            pending = [club_url for club_url in crawl_links if club_url not in done]
+            print(f"Пачка {chunk}: {len(crawl_links)} клубов, осталось {len(pending)}")
+            crawl_clubs(pending, done, journal_file, workers, heartbeat_file=claimed_path)
+            failed = sum(1 for club_url in crawl_links if club_url not in done)
+            target = os.path.join(queue_dir, "pending" if failed else "done", chunk)
+            try:
+                os.rename(claimed_path, target)
+            except OSError:
+                # Пачку сочли брошенной и забрал другой обработчик — он ее и завершит
+                print(f"Пачка {chunk} передана другому обработчику")
+                continue
+            if failed:
+                returned[chunk] = failed
+                print(f"Пачка {chunk}: не удалось обработать {failed} клубов, пачка возвращена в очередь")
+        if returned:
+            print(
+                f"Обработано пачек: {chunks}. Возвращены в очередь с необработанными клубами ({sum(returned.values())}): "
+                f"{', '.join(sorted(returned))}. Запустите обработчик повторно, чтобы догрузить их, затем --merge"
+            )
+        else:
+            print(f"Очередь '{queue_dir}' пуста, обработано пачек: {chunks}. Когда все обработчики закончат, запустите --merge")
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+    finally:
+        finish_run(CRAWLER_METRICS_FILE.replace(".prom", f".{queue_worker_id()}.prom"))
+
+# Сборка таблицы из журналов частей. Один админ бывает в клубах из разных частей и проверяется
+# каждой частью отдельно: берем самое свежее время визита и пересчитываем статусы по нему,
+# повторы админа внутри клуба убираем. partials_dir — папка журналов частей или папка очереди.
+# Когда обработаны все клубы, журналы (и файлы очереди) удаляются
+def merge_partials(partials_dir=PARTIALS_DIR, filename="lichess_club_admins.xlsx"):
+    club_links = read_club_links()
+    is_queue = os.path.isdir(os.path.join(partials_dir, "partials"))
+    if is_queue:
+        journal_files = sorted(glob.glob(os.path.join(partials_dir, "partials", "*.jsonl")))
+    else:
+        journal_files = sorted(glob.glob(os.path.join(partials_dir, f"shard-*-of-*-{club_list_digest(club_links)}.jsonl")))
+        # Части разных разбиений (например, -of-2 и -of-4) относятся к разным запускам
+        counts = sorted({re.match(r"shard-\d+-of-(\d+)-", os.path.basename(path)).group(1) for path in journal_files})
+        if len(counts) > 1:
+            print(
+                f"В '{partials_dir}' есть журналы разных разбиений ({', '.join('из ' + count for count in counts)}). "
+                f"Удалите журналы прежнего запуска и повторите --merge"
+            )
+            return
+        skipped = len(glob.glob(os.path.join(partials_dir, "*.jsonl"))) - len(journal_files)
+        if skipped:
+            print(f"Пропущено {skipped} журналов другого списка клубов")
+    done = {}
+    for journal_file in journal_files:
+        done.update(load_journal(journal_file))
+    latest_seen = {}
+    admin_names = {}
+    for admins in done.values():
+        for admin_url, admin_name, _, last_seen in admins:
+            admin_names.setdefault(admin_url, admin_name)
+            if last_seen and (latest_seen.get(admin_url) is None or last_seen > latest_seen[admin_url]):
+                latest_seen[admin_url] = last_seen
+            else:
+                latest_seen.setdefault(admin_url, None)
+    for club_url, admins in done.items():
+        done[club_url] = [
+            [admin_url, admin_names[admin_url], activity_status(admin_url, latest_seen[admin_url]), latest_seen[admin_url]]
+            for admin_url in dict.fromkeys(admin[0] for admin in admins)
+        ]
+    build_workbook(club_links, done, filename)
+    missing = sum(1 for club_url in dict.fromkeys(club_links) if club_url not in done)
+    print(
+        f"Собрано {len(journal_files)} частей: {len(done)} клубов, {len(latest_seen)} разных админов. "
+        f"Данные сохранены в '{filename}'"
+    )
+    if missing:
+        print(f"Нет данных для {missing} клубов: дообработайте незавершенные части и повторите --merge")
+        return
+    for path in queue_files(partials_dir) if is_queue else journal_files:
+        os.remove(path)
+    print("Журналы частей удалены: следующий обход начнется заново")
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("ожидается формат i/n, например 1/4")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("номер части должен быть от 1 до n")
+    return index, count
+
+# Колонки статусов в строке: D, G, ..., AE до колонки AF и каждая третья после нее
+def status_columns(max_column):
+    columns = list(range(4, AF_COLUMN_INDEX, 3))  # D, G, J, M, P, S, V, Y, AB, AE
+    columns.extend(range(AF_COLUMN_INDEX + 3, max_column + 1, 3))
+    return columns
 
-# Функция для вычисления суммы в колонке AF
-def calculate_af_column():
+# Функция для вычисления суммы в колонке AF. collect_data считает AF сам, функция нужна
+# только для пересчета уже существующего файла
+def calculate_af_column(filename='lichess_club_admins.xlsx'):
     print("Вычисляем значения для колонки AF...")
-    filename = 'lichess_club_admins.xlsx'
     wb = load_workbook(filename)
     ws = wb.active
-    columns_to_sum = [4, 7, 10, 13, 16, 19, 22, 25, 28, 31]  # D, G, J, M, P, S, V, Y, AB, AE
-    af_column_index = 32  # AF
-    for row in ws.iter_rows(min_row=2, max_col=max(columns_to_sum + [af_column_index]), values_only=False):
-        sum_value = sum(cell.value if cell.value is not None else 0 for idx, cell in enumerate(row) if idx + 1 in columns_to_sum)
-        row[af_column_index - 1].value = sum_value
+    columns_to_sum = status_columns(ws.max_column)
+    for row in ws.iter_rows(min_row=2, max_col=max(columns_to_sum + [AF_COLUMN_INDEX]), values_only=False):
+        sum_value = sum(row[idx - 1].value or 0 for idx in columns_to_sum)
+        row[AF_COLUMN_INDEX - 1].value = sum_value
     wb.save(filename)
     print("Значения для колонки AF успешно вычислены и записаны.")
 
 if __name__ == "__main__":
-    collect_data()
-    calculate_af_column()
+    parser = argparse.ArgumentParser(description="Сбор администраторов клубов Lichess")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS, help="количество потоков (1 — последовательно)")
+    parser.add_argument("--per-host", type=int, default=PER_HOST_LIMIT, help="лимит одновременных запросов к одному хосту")
+    parser.add_argument("--cache-ttl", type=float, default=ADMIN_CACHE_TTL / 3600, help="срок жизни кэша администраторов в часах (0 — без кэша)")
+    parser.add_argument("--fresh", action="store_true", help="начать обход заново, удалив журнал прошлого запуска")
+    parser.add_argument("--recalculate-af", action="store_true", help="только пересчитать колонку AF в существующем файле")
+    parser.add_argument("--extractor", choices=("fast", "bs4"), default=EXTRACTOR, help="способ разбора HTML")
+    parser.add_argument("--shard", type=parse_shard, help="обойти только часть i из n (i/n, нумерация с 1)")
+    parser.add_argument("--partials-dir", default=PARTIALS_DIR, help="папка журналов частей (может быть общей)")
+    parser.add_argument("--queue", help="папка очереди пачек на общем диске: обработать пачки из нее")
+    parser.add_argument("--init-queue", action="store_true", help="разбить clubs_domens.txt на пачки в папке --queue")
+    parser.add_argument("--chunk-size", type=int, default=QUEUE_CHUNK_SIZE, help="клубов в пачке очереди")
+    parser.add_argument("--merge", action="store_true", help="собрать таблицу из журналов частей (--partials-dir или --queue)")
+    args = parser.parse_args()
+    EXTRACTOR = args.extractor
+    ADMIN_CACHE_TTL = args.cache_ttl * 3600
+    PARTIALS_DIR = args.partials_dir
+    # --fresh с --init-queue очищает папку очереди (в init_queue), иначе удаляется журнал
+    # обычного обхода или этой части
+    if args.fresh and args.queue and not args.init_queue:
+        parser.error("--fresh с --queue используется только вместе с --init-queue")
+    if args.fresh and not args.queue:
+        journal_file = shard_journal_file(args.shard, club_list_digest(read_club_links())) if args.shard else CRAWL_JOURNAL_FILE
+        if os.path.exists(journal_file):
+            os.remove(journal_file)
+    if args.recalculate_af:
+        calculate_af_column()
+    elif args.merge:
+        merge_partials(args.queue or PARTIALS_DIR)
+    elif args.init_queue:
+        if not args.queue:
+            parser.error("--init-queue требует --queue")
+        init_queue(args.queue, args.chunk_size, fresh=args.fresh)
+    elif args.queue:
+        configure_concurrency(args.workers, args.per_host)
+        crawl_queue(args.queue)
+    else:
+        configure_concurrency(args.workers, args.per_host)
+        collect_data(shard=args.shard)